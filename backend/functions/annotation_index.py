@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+INDEX_ARRAYS = ('indptr', 'indices', 'vocab', 'set_name', 'set_type')
+
+
+def annotation_index_path(fp_anno: str) -> str:
+    # df_annotation_sub_structural.csv -> df_annotation_sub_structural.idx
+    return os.path.splitext(fp_anno)[0] + '.idx'
+
+
+def build_annotation_index(fp_anno: str, fp_index: str = None) -> str:
+    # Compile an annotation CSV into a sets x cysteines CSR incidence matrix
+    # plus the cysteine-ID vocabulary, stored as plain .npy arrays so that
+    # load_annotation_index can memory-map them.
+    if fp_index is None:
+        fp_index = annotation_index_path(fp_anno)
+    os.makedirs(fp_index, exist_ok=True)
+
+    df_annotation_sub = pd.read_csv(fp_anno, header=0, index_col=0)
+    S_cys = df_annotation_sub['cys'].str.split(',')
+
+    df_pairs = pd.DataFrame({
+        'row': np.repeat(np.arange(len(S_cys)), S_cys.apply(len).to_numpy()),
+        'cys': np.concatenate(S_cys.to_list()) if len(S_cys) > 0 else np.array([], dtype=str),
+    })
+    vocab = np.sort(df_pairs['cys'].unique()).astype(str)
+    df_pairs['col'] = pd.Index(vocab).get_indexer(df_pairs['cys'])
+    # a set lists each cysteine once as far as the overlap count is concerned
+    df_pairs = df_pairs.drop_duplicates(['row', 'col']).sort_values(['row', 'col'])
+
+    indptr = np.zeros(len(S_cys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(df_pairs['row'], minlength=len(S_cys)), out=indptr[1:])
+
+    arrays = {
+        'indptr': indptr,
+        'indices': df_pairs['col'].to_numpy(dtype=np.int32),
+        'vocab': vocab,
+        'set_name': df_annotation_sub['set_name'].to_numpy(dtype=str),
+        'set_type': df_annotation_sub['set_type'].to_numpy(dtype=str),
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(fp_index, f'{name}.npy'), arr, allow_pickle=False)
+
+    return fp_index
+
+
+def load_annotation_index(fp_index: str, mmap_mode: str = 'r') -> dict:
+    arrays = {
+        name: np.load(os.path.join(fp_index, f'{name}.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+        for name in INDEX_ARRAYS
+    }
+    n_sets = len(arrays['indptr']) - 1
+    matrix = csr_matrix(
+        (np.ones(len(arrays['indices']), dtype=np.int32), arrays['indices'], arrays['indptr']),
+        shape=(n_sets, len(arrays['vocab'])),
+    )
+    # vocab stays the memory-mapped sorted array; lookups are binary searches
+    return {
+        'matrix': matrix,
+        'vocab': arrays['vocab'],
+        'set_name': arrays['set_name'],
+        'set_type': arrays['set_type'],
+    }
+
+
+def vocab_positions(vocab, S_cys) -> np.ndarray:
+    # positions of the IDs in the sorted vocab array, -1 for IDs it lacks
+    ids = np.asarray(pd.Series(S_cys, dtype=object).astype(str).to_numpy(), dtype=str)
+    if len(vocab) == 0 or len(ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(vocab, ids), len(vocab) - 1)
+    return np.where(vocab[pos] == ids, pos, -1)
+
+
+def count_set_overlaps(index: dict, S_cys) -> np.ndarray:
+    # one sparse mat-vec against the foreground indicator vector
+    pos = vocab_positions(index['vocab'], S_cys)
+    indicator = np.zeros(len(index['vocab']), dtype=np.int32)
+    indicator[pos[pos >= 0]] = 1
+    return np.asarray(index['matrix'] @ indicator).ravel()
+
+
+def set_members(index: dict, rows) -> list:
+    matrix = index['matrix']
+    return [
+        index['vocab'][matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]]].tolist()
+        for i in rows
+    ]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compile annotation CSVs into sparse CSEA indexes')
+    parser.add_argument('fp_anno', nargs='+', help='df_annotation_sub_*.csv files to compile')
+    args = parser.parse_args()
+
+    for fp_anno in args.fp_anno:
+        fp_index = build_annotation_index(fp_anno)
+        print(f"Saved index for {fp_anno} to {fp_index}")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import tempfile
+import platform
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from csea500b import (
+    load_inputs,
+    read_annotation_background,
+    intersecting_sets,
+    perform_permutation,
+    run_csea_analysis,
+)
+from cys_ids import annotated_codes
+from instrumentation import StageTimings
+
+
+# foreground size, number of annotation sets, n_perm
+GRIDS = {
+    'quick': [
+        (100, 1000, 100),
+        (1000, 1000, 100),
+        (1000, 10000, 500),
+    ],
+    'full': [
+        (n_fg, n_sets, n_perm)
+        for n_fg in (100, 1000, 10000, 50000)
+        for n_sets in (1000, 10000, 100000)
+        for n_perm in (100, 1000, 10000)
+    ],
+}
+
+
+def synthetic_cys_ids(n: int, rng) -> np.ndarray:
+    # IDs shaped like the real ones: UniProt-like accession and cysteine position
+    proteins = rng.integers(0, max(n // 5, 1), n)
+    positions = rng.integers(1, 2000, n)
+    ids = pd.Series([f"P{p:05d}_C{c}" for p, c in zip(proteins, positions)]).drop_duplicates()
+    while len(ids) < n:
+        extra = pd.Series([f"Q{p:05d}_C{c}" for p, c in zip(
+            rng.integers(0, 99999, n - len(ids)), rng.integers(1, 2000, n - len(ids)))])
+        ids = pd.concat([ids, extra]).drop_duplicates()
+    return ids.to_numpy()[:n]
+
+
+def generate_synthetic_inputs(out_dir: str, n_fg: int, n_sets: int, seed: int = 0,
+                              n_bg: int = None, set_size_mean: float = 30.0) -> dict:
+    # Writes a foreground list, a tissue background, an annotation table and
+    # its background list with the same layout as the reference CSVs.
+    rng = np.random.default_rng(seed)
+    if n_bg is None:
+        n_bg = max(4 * n_fg, 10000)
+    os.makedirs(out_dir, exist_ok=True)
+
+    universe = synthetic_cys_ids(int(n_bg * 1.25), rng)
+    bg = universe[:n_bg]
+    fg = rng.choice(bg, n_fg, replace=False)
+    # annotation covers most of the background plus cysteines outside it
+    anno_universe = np.concatenate([
+        rng.choice(bg, int(n_bg * 0.8), replace=False),
+        universe[n_bg:],
+    ])
+    # annotation cysteines use a space where the input lists use '_'
+    anno_universe = np.char.replace(anno_universe.astype(str), '_', ' ')
+
+    set_sizes = np.clip(rng.geometric(1 / set_size_mean, n_sets), 3, len(anno_universe))
+    ls_cys = [','.join(rng.choice(anno_universe, k, replace=False)) for k in set_sizes]
+    df_anno = pd.DataFrame({
+        'set_name': [f"synthetic set {i}" for i in range(n_sets)],
+        'set_type': rng.choice(['domain', 'site', 'region', 'pathway'], n_sets),
+        'cys': ls_cys,
+    })
+
+    paths = {
+        'fp_cys': os.path.join(out_dir, 'foreground.csv'),
+        'fp_bg': os.path.join(out_dir, 'background.csv'),
+        'fp_anno': os.path.join(out_dir, 'df_annotation_sub_synthetic.csv'),
+        'fp_anno_bgcys': os.path.join(out_dir, 'bgcys_anno_synthetic.csv'),
+    }
+    pd.Series(fg).to_csv(paths['fp_cys'], header=False, index=False)
+    pd.Series(bg).to_csv(paths['fp_bg'], header=False, index=False)
+    df_anno.to_csv(paths['fp_anno'], header=True, index=True)
+    pd.Series(anno_universe).to_csv(paths['fp_anno_bgcys'], header=False, index=False)
+    return paths
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, time.perf_counter() - t0
+
+
+def benchmark_config(n_fg: int, n_sets: int, n_perm: int, seed: int = 0, **run_kwargs) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = generate_synthetic_inputs(tmp, n_fg, n_sets, seed)
+        metrics = {}
+
+        # the same inputs, vocabulary and overlap counting as run_csea_analysis
+        inputs, metrics['load_inputs_s'] = timed(load_inputs, paths['fp_cys'], paths['fp_bg'])
+        vocab = inputs['vocab']
+        anno_mask = vocab.mask(vocab.intern(read_annotation_background(paths['fp_anno_bgcys'])))
+        S_cys_inAnno = pd.Series(annotated_codes(inputs['codes_cys'], anno_mask))
+        S_bg_inAnno = pd.Series(annotated_codes(inputs['codes_bg'], anno_mask))
+
+        df_res_X, metrics['set_overlap_s'] = timed(
+            intersecting_sets, paths['fp_anno'], run_kwargs.get('fp_anno_index'), vocab, S_cys_inAnno)
+
+        timings = StageTimings()
+        _, metrics['perform_permutation_s'] = timed(
+            perform_permutation, df_res_X, S_cys_inAnno, S_bg_inAnno, len(df_res_X),
+            n_perm, len(S_cys_inAnno), seed=seed, timings=timings,
+            **{k: v for k, v in run_kwargs.items()
+               if k in ('engine', 'null_mode', 'kde_backend', 'n_workers')})
+        stages = timings.as_dict()
+        metrics['permutation_s'] = stages.get('permutation', {}).get('wall_s', 0.0)
+        metrics['pvalue_s'] = stages.get('pvalue', {}).get('wall_s', 0.0)
+
+        _, metrics['end_to_end_s'] = timed(
+            run_csea_analysis, paths['fp_cys'], paths['fp_bg'], paths['fp_anno'],
+            paths['fp_anno_bgcys'], os.path.join(tmp, 'out'), n_perm=n_perm, seed=seed,
+            **run_kwargs)
+
+    return {
+        'n_fg': n_fg,
+        'n_sets': n_sets,
+        'n_perm': n_perm,
+        'n_sets_intersecting': int(len(df_res_X)),
+        'metrics': {k: round(v, 4) for k, v in metrics.items()},
+    }
+
+
+def run_benchmarks(grid, **run_kwargs) -> dict:
+    results = []
+    for n_fg, n_sets, n_perm in grid:
+        print(f"Benchmark n_fg={n_fg} n_sets={n_sets} n_perm={n_perm}...")
+        results.append(benchmark_config(n_fg, n_sets, n_perm, **run_kwargs))
+        print(json.dumps(results[-1]['metrics']))
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'run_kwargs': run_kwargs,
+        'results': results,
+    }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float = 0.2,
+                        min_seconds: float = 0.05) -> list:
+    # a metric regresses when it is slower than the baseline by more than
+    # tolerance; timings below min_seconds are too noisy to judge
+    key = lambda r: (r['n_fg'], r['n_sets'], r['n_perm'])
+    baseline_by_key = {key(r): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        base = baseline_by_key.get(key(result))
+        if base is None:
+            continue
+        for metric, value in result['metrics'].items():
+            base_value = base['metrics'].get(metric)
+            if base_value is None or max(value, base_value) < min_seconds:
+                continue
+            if value > base_value * (1 + tolerance):
+                regressions.append({
+                    'n_fg': result['n_fg'],
+                    'n_sets': result['n_sets'],
+                    'n_perm': result['n_perm'],
+                    'metric': metric,
+                    'baseline_s': base_value,
+                    'current_s': value,
+                    'ratio': round(value / base_value, 3) if base_value > 0 else None,
+                })
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description='Synthetic-scale benchmarks for the CSEA pipeline')
+    parser.add_argument('--grid', default='quick', choices=sorted(GRIDS), help='Size grid to run')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results JSON')
+    parser.add_argument('--baseline', default=None, help='Baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown relative to the baseline before flagging a regression')
+    parser.add_argument('--engine', default='vectorized', choices=['loop', 'vectorized'])
+    parser.add_argument('--null_mode', default='per_set', choices=['per_set', 'shared'])
+    parser.add_argument('--kde_backend', default='quad', choices=['quad', 'closed_form'])
+    parser.add_argument('--n_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        GRIDS[args.grid],
+        engine=args.engine,
+        null_mode=args.null_mode,
+        kde_backend=args.kde_backend,
+        n_workers=args.n_workers,
+    )
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved benchmark results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION n_fg={r['n_fg']} n_sets={r['n_sets']} n_perm={r['n_perm']} "
+                  f"{r['metric']}: {r['baseline_s']}s -> {r['current_s']}s (x{r['ratio']})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
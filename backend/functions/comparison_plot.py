@@ -10,6 +10,11 @@ import pandas as pd
 
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# reference version -> set_name x tissue table of reference p_final
+_reference_tables = {}
 
 def generate_feature_plot_with_reference_comparison(
         fp_user_result:str, 
@@ -68,4 +73,113 @@ def generate_feature_plot_with_reference_comparison(
 
     plt.savefig(fpout, dpi=300, bbox_inches='tight')
     
-    return fpout
\ No newline at end of file
+    return fpout
+
+
+def reference_version(fp_ref_dir: str) -> str:
+    # changes whenever a reference result file is added, removed or rewritten
+    files = sorted(glob(os.path.join(fp_ref_dir, '*.csv')))
+    return '|'.join(f"{os.path.basename(fp)}:{os.path.getsize(fp)}:{int(os.path.getmtime(fp))}"
+                    for fp in files)
+
+
+def load_reference_table(fp_ref_dir: str, version: str = None) -> pd.DataFrame:
+    # Every reference result CSV in fp_ref_dir (one per tissue, named after the
+    # tissue) read once into one table indexed by set_name with a p_final
+    # column per tissue. Cached per reference version.
+    if version is None:
+        version = reference_version(fp_ref_dir)
+    if version in _reference_tables:
+        return _reference_tables[version]
+
+    columns = {}
+    for fp in sorted(glob(os.path.join(fp_ref_dir, '*.csv'))):
+        tissue = os.path.splitext(os.path.basename(fp))[0]
+        df_ref = pd.read_csv(fp, usecols=['set_name', 'p_final'])
+        columns[tissue] = df_ref.drop_duplicates('set_name').set_index('set_name')['p_final']
+    df_table = pd.DataFrame(columns)
+    df_table.index.name = 'set_name'
+
+    _reference_tables.clear()
+    _reference_tables[version] = df_table
+    return df_table
+
+
+def compare_to_references(df_user: pd.DataFrame, df_ref_table: pd.DataFrame,
+                          p_final: float = 0.05, top_n: int = 20) -> pd.DataFrame:
+    # -log10p of the user's top significant features next to every tissue, in
+    # one vectorised step; features missing from a reference get 0 as in the
+    # single-reference plot
+    df_user = df_user[df_user['p_final'] < p_final].drop_duplicates('set_name').head(top_n)
+    features = df_user['set_name'].to_numpy()
+
+    ref_p = df_ref_table.reindex(features).to_numpy(dtype=float)
+    with np.errstate(divide='ignore'):
+        ref_log = np.nan_to_num(-np.log10(ref_p), nan=0.0, posinf=0.0)
+        user_log = -np.log10(df_user['p_final'].to_numpy(dtype=float))
+
+    df_matrix = pd.DataFrame(ref_log, index=features, columns=df_ref_table.columns)
+    df_matrix.insert(0, 'user', user_log)
+    df_matrix.index.name = 'set_name'
+    return df_matrix.sort_values('user', ascending=True)
+
+
+def generate_feature_plot_with_all_references(
+        fp_user_result: str,
+        fp_ref_dir: str,
+        fpout: str,
+        fp_table_out: str = None,
+        p_final: float = 0.05) -> str:
+    # Heatmap of the user's top features against every reference tissue in
+    # fp_ref_dir, beside the user's own bars; optionally writes the matrix to
+    # fp_table_out. Returns None when no feature passes p_final.
+    df_matrix = compare_to_references(
+        pd.read_csv(fp_user_result), load_reference_table(fp_ref_dir), p_final)
+    if df_matrix.shape[0] == 0:
+        return None
+    if fp_table_out is not None:
+        df_matrix.to_csv(fp_table_out)
+
+    df_ref_log = df_matrix.drop(columns='user')
+    n_features, n_tissues = df_ref_log.shape
+
+    fig = Figure(figsize=(max(6, 0.35 * n_tissues + 4), max(4, 0.3 * n_features + 1)))
+    FigureCanvasAgg(fig)
+    ax1, ax2 = fig.subplots(1, 2, sharey=True, gridspec_kw={'width_ratios': [max(n_tissues, 1), 3]})
+
+    im = ax1.imshow(df_ref_log.to_numpy(), aspect='auto', cmap='Reds', origin='lower')
+    ax1.set_xticks(range(n_tissues))
+    ax1.set_xticklabels(df_ref_log.columns, rotation=90)
+    ax1.set_yticks(range(n_features))
+    ax1.set_yticklabels(df_matrix.index)
+    ax1.set_xlabel('Reference tissue')
+    fig.colorbar(im, ax=ax1, label='-log10p', location='left')
+
+    ax2.barh(range(n_features), df_matrix['user'], color='skyblue')
+    ax2.set_xlabel('-log10p')
+    ax2.set_title('User Input')
+
+    fig.suptitle('Left: Reference tissues, Right: User Input')
+    fig.subplots_adjust(wspace=0.05)
+    try:
+        fig.savefig(fpout, dpi=300, bbox_inches='tight')
+    finally:
+        fig.clear()
+
+    return fpout
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare a CSEA result against every reference tissue')
+    parser.add_argument('--fp_user_result', required=True, help='result_*.csv of the user run')
+    parser.add_argument('--fp_ref_dir', required=True, help='Directory of reference result CSVs, one per tissue')
+    parser.add_argument('--fpout', required=True, help='Output image path')
+    parser.add_argument('--fp_table_out', default=None, help='Optional CSV of the -log10p matrix')
+    parser.add_argument('--p_final', type=float, default=0.05)
+    args = parser.parse_args()
+
+    fp = generate_feature_plot_with_all_references(
+        args.fp_user_result, args.fp_ref_dir, args.fpout, args.fp_table_out, args.p_final)
+    print(f"Saved comparison plot to {fp}" if fp is not None else "No feature passes p_final")
@@ -2,65 +2,404 @@
 import os
 from glob import glob
 import io
-from io import StringIO
-from datetime import datetime
-from tqdm import tqdm
 
 import numpy as np
 import pandas as pd
 
 import re
-from collections import Counter
+import json
+import hashlib
+import tempfile
+import contextlib
+import threading
+import multiprocessing
+import time
 from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
-from scipy.stats import gaussian_kde
+from scipy.stats import gaussian_kde, binom, norm
 from scipy.integrate import quad
 from statsmodels.stats.multitest import multipletests
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
+from cys_ids import read_cys_ids, CysVocabulary, annotated_codes, count_member_overlaps, member_hits
+from annotation_index import build_annotation_index, load_annotation_index, count_set_overlaps, set_members
+from instrumentation import StageTimings
 
-def create_output_directory(base_path):
-    os.makedirs(base_path, exist_ok=True)
-    return base_path
 
+def read_annotation_background(fp_anno_bgcys) -> list:
+    # fp_anno_bgcys is either a CSV path or the already loaded annotation cysteines
+    if isinstance(fp_anno_bgcys, str):
+        return pd.read_csv(fp_anno_bgcys, header=None)[0].to_list()
+    return list(fp_anno_bgcys)
 
-def get_input_and_bg_cys(fp_cys: str, fp_bg: str):
-    df_cys = pd.read_csv(fp_cys, header=None)
-    S_cys = df_cys.iloc[:,0].apply(lambda x: re.sub('_', ' ', x))
 
-    df_bg = pd.read_csv(fp_bg, header=None)
-    S_bg = df_bg.iloc[:,0].apply(lambda x: re.sub('_', ' ', x))
+def load_background(fp_bg) -> dict:
+    # the background parsed and interned first, so its codes do not depend on
+    # the foreground and can be shared by several foreground lists
+    S_bg, n_bg_malformed = read_cys_ids(fp_bg)
+    vocab = CysVocabulary()
+    return {
+        'S_bg': S_bg,
+        'n_bg_malformed': n_bg_malformed,
+        'vocab': vocab,
+        'codes_bg': vocab.intern(S_bg),
+    }
 
-    return S_cys, S_bg
 
+def add_foreground(background: dict, fp_cys: str) -> dict:
+    # inputs for one foreground list against a loaded background; the
+    # foreground is interned into the background's vocabulary
+    S_cys, n_cys_malformed = read_cys_ids(fp_cys)
+    return {
+        'S_cys': S_cys,
+        'S_bg': background['S_bg'],
+        'malformed': {'n_cys_malformed': n_cys_malformed, 'n_bg_malformed': background['n_bg_malformed']},
+        'vocab': background['vocab'],
+        'codes_cys': background['vocab'].intern(S_cys),
+        'codes_bg': background['codes_bg'],
+    }
 
-def get_annotated_cys(ls_cys, ls_annotation):
-    S_inAnno = pd.Series(list(set(ls_annotation).intersection(ls_cys)))
-    return S_inAnno.copy()
 
+def load_inputs(fp_cys: str, fp_bg) -> dict:
+    # foreground and background parsed and interned once, so that several
+    # annotations can be run against them with the same vocabulary
+    return add_foreground(load_background(fp_bg), fp_cys)
 
-def generate_perm(n_perm, size_per_perm, n_feature, S_bgcys, S_cys, seed: int = 42):
-    np.random.seed(seed)
-    random_draws = np.random.choice(
-        S_bgcys,
-        (n_feature, n_perm, size_per_perm),
-        replace=True)
-    S = pd.Series(random_draws.tolist())
-    return random_draws
+
+def annotate_inputs(inputs: dict, ls_bgcys_anno):
+    # mask of annotated codes, and the unique annotated background codes and
+    # the annotated foreground codes the background contains, in code order.
+    # As in the per-tissue run, overlaps are counted against that foreground
+    # and each permutation draws that many cysteines.
+    vocab = inputs['vocab']
+    anno_mask = vocab.mask(vocab.intern(ls_bgcys_anno))
+    S_bg_inAnno = pd.Series(annotated_codes(inputs['codes_bg'], anno_mask))
+    S_cys_inAnno = pd.Series(np.intersect1d(annotated_codes(inputs['codes_cys'], anno_mask), S_bg_inAnno))
+    return anno_mask, S_cys_inAnno, S_bg_inAnno
 
 
-def calculate_n_intersect(ls_ls_perm, S_cys):
-    ls_n_intersection = [len(set(ls_perm).intersection(S_cys))
-                         for ls_perm in ls_ls_perm]
-    return ls_n_intersection
+def get_annotated_cys(ls_cys, ls_annotation):
+    S_cys = pd.Series(pd.unique(pd.Series(ls_cys, dtype=object)), dtype=object)
+    return S_cys[S_cys.isin(ls_annotation)].reset_index(drop=True)
 
 
 def calculate_bin_midpoints(bin_edges):
     return (bin_edges[:-1] + bin_edges[1:]) / 2
 
 
+def encode_foreground_mask(S_bg_inAnno, S_cys_inAnno):
+    # position i of the mask is True when background cysteine i is in the foreground
+    return pd.Series(S_bg_inAnno).isin(set(S_cys_inAnno)).to_numpy()
+
+
+def count_unique_hits(draws, fg_mask):
+    # draws: (n_perm, size_per_perm) integer indices into the background
+    hits = np.where(fg_mask[draws], draws, -1)
+    hits.sort(axis=1)
+    is_new = np.empty(hits.shape, dtype=bool)
+    is_new[:, 0] = True
+    np.not_equal(hits[:, 1:], hits[:, :-1], out=is_new[:, 1:])
+    return ((hits >= 0) & is_new).sum(axis=1)
+
+
+def draw_null_intersections_per_background(ls_n_bg, ls_n_fg, n_perm: int, size_per_perm, rng=None):
+    # (n_backgrounds, n_perm) null counts for several backgrounds at once,
+    # drawn by compute_null_counts_many from one block of uniform draws, so a
+    # background gets the same shared null as a pooled run against it with
+    # the same seed. size_per_perm is one draw size for all backgrounds or one
+    # per background.
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 31))
+    ls_size = np.broadcast_to(np.asarray(size_per_perm, dtype=int), (len(ls_n_bg),))
+    max_size = int(ls_size.max()) if len(ls_size) else 0
+    counts = np.zeros((len(ls_n_bg), n_perm), dtype=np.min_scalar_type(max_size))
+    ls_sizes = [(int(n_bg), int(n_fg), int(size)) for n_bg, n_fg, size in zip(ls_n_bg, ls_n_fg, ls_size)]
+    for i, n_intersect in enumerate(compute_null_counts_many(ls_sizes, n_perm, rng)):
+        counts[i] = n_intersect
+    return counts
+
+
+def draw_null_intersections(S_cys_inAnno,
+                            S_bg_inAnno,
+                            n_perm: int,
+                            size_per_perm: int,
+                            engine: str = 'vectorized',
+                            fg_mask=None,
+                            rng=None):
+    # rng is a per-set numpy Generator; without one the global stream is used
+    if rng is None:
+        rng = np.random
+    if engine == 'vectorized':
+        if fg_mask is None:
+            fg_mask = encode_foreground_mask(S_bg_inAnno, S_cys_inAnno)
+        # same RNG stream as the loop engine: choice() over a population
+        # draws integer positions, so drawing positions directly matches it
+        random_draws = rng.choice(len(fg_mask), (n_perm, size_per_perm), replace=True)
+        return count_unique_hits(random_draws, fg_mask).tolist()
+
+    random_draws = rng.choice(np.asarray(S_bg_inAnno), (n_perm, size_per_perm), replace=True)
+    return [
+        len(set(random_draws[j]).intersection(S_cys_inAnno))
+        for j in range(n_perm)
+    ]
+
+
+# The shared null only depends on how many annotated background cysteines
+# there are, how many of them are foreground, how many cysteines each
+# permutation draws, how many permutations are drawn and the seed. Labels are
+# exchangeable, so it is drawn against a canonical mask in which the first
+# n_fg background positions are the foreground; the null library stores
+# exactly these counts, so runs with and without a library agree.
+def compute_null_counts(n_bg: int, n_fg: int, size_per_perm: int, n_perm: int, seed: int,
+                        engine: str = 'vectorized'):
+    return compute_null_counts_many([(n_bg, n_fg, size_per_perm)], n_perm, seed, engine)[0]
+
+
+def compute_null_counts_many(ls_sizes, n_perm: int, seed: int, engine: str = 'vectorized'):
+    # null counts for several (n_bg, n_fg, size_per_perm) triples from one
+    # block of uniform draws, each scaled to its background. The block is
+    # filled one draw position at a time across all permutations, so its first
+    # size_per_perm positions are what that size alone draws with this seed,
+    # and every triple gets the same null it would get on its own.
+    # seed is an int or a numpy Generator to draw from
+    rng = np.random.default_rng(seed)
+    max_size = max((size for _, _, size in ls_sizes), default=0)
+    u = rng.random((max_size, n_perm)).T
+    drawn = {}
+    for n_bg, n_fg, size in ls_sizes:
+        if (n_bg, n_fg, size) in drawn:
+            continue
+        if n_bg == 0 or n_fg == 0 or size == 0:
+            drawn[(n_bg, n_fg, size)] = [0] * n_perm
+            continue
+        draws = (u[:, :size] * n_bg).astype(np.int64)
+        if engine == 'vectorized':
+            fg_mask = np.zeros(n_bg, dtype=bool)
+            fg_mask[:n_fg] = True
+            drawn[(n_bg, n_fg, size)] = count_unique_hits(draws, fg_mask).tolist()
+        else:
+            # positions below n_fg stand in for the foreground ids
+            drawn[(n_bg, n_fg, size)] = [len(set(row[row < n_fg].tolist())) for row in draws]
+    return [drawn[triple] for triple in ls_sizes]
+
+
+def fit_null_density(n_intersect):
+    hist_vals, bin_edges = np.histogram(n_intersect, bins='auto', density=True)
+    bin_mids = calculate_bin_midpoints(bin_edges)
+    kde_fit = gaussian_kde(n_intersect) if len(bin_mids) > 2 else np.NaN
+    return {
+        'ls_n_intersection': n_intersect,
+        'hist': hist_vals,
+        'bin_edges': bin_edges,
+        'bin_midpoints': bin_mids,
+        'kde': kde_fit,
+    }
+
+
+def kde_tail_probability(kde_fit, x):
+    # the tail of a 1-D gaussian_kde above x is the weighted sum of the normal
+    # survival functions of its kernels, evaluated for every query point at once
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    centers = kde_fit.dataset[0]
+    bandwidth = np.sqrt(kde_fit.covariance[0, 0])
+    return norm.sf((x[:, None] - centers[None, :]) / bandwidth) @ kde_fit.weights
+
+
+def score_against_null(null, n_cys_x, log_offset: float = 0.0001, kde_backend: str = 'quad'):
+    if len(null['bin_midpoints']) <= 2:
+        return (np.NaN, np.NaN), np.NaN, np.NaN
+    if kde_backend == 'closed_form':
+        pval = float(kde_tail_probability(null['kde'], n_cys_x)[0])
+        integral_val = (pval, 0.0)
+    else:
+        integral_val = quad(null['kde'], n_cys_x, np.inf, epsrel=1e-4, epsabs=1e-6)
+        pval = integral_val[0]
+    return integral_val, pval, -np.log10(pval + log_offset)
+
+
+def score_many_against_null(null, ls_n_cys_x, log_offset: float = 0.0001):
+    # closed-form scores for many query points against one fitted null
+    if len(null['bin_midpoints']) <= 2:
+        return {x: ((np.NaN, np.NaN), np.NaN, np.NaN) for x in ls_n_cys_x}
+    pvals = kde_tail_probability(null['kde'], ls_n_cys_x)
+    return {
+        x: ((float(p), 0.0), float(p), -np.log10(p + log_offset))
+        for x, p in zip(ls_n_cys_x, pvals)
+    }
+
+
+def sequential_null_intersections(S_cys_inAnno,
+                                  S_bg_inAnno,
+                                  n_cys_x,
+                                  n_perm_max: int,
+                                  size_per_perm: int,
+                                  engine: str = 'vectorized',
+                                  fg_mask=None,
+                                  perm_step: int = 50,
+                                  min_exceedances: int = 10,
+                                  rng=None):
+    # Besag-Clifford sequential Monte Carlo: keep drawing permutations in steps
+    # of perm_step and stop as soon as min_exceedances null draws reach the
+    # observed overlap, or when n_perm_max permutations have been drawn
+    ls_n_intersection = []
+    n_exceed = 0
+    while len(ls_n_intersection) < n_perm_max:
+        n_draw = min(perm_step, n_perm_max - len(ls_n_intersection))
+        n_intersect = np.asarray(draw_null_intersections(
+            S_cys_inAnno, S_bg_inAnno, n_draw, size_per_perm, engine, fg_mask, rng))
+        cum_exceed = n_exceed + np.cumsum(n_intersect >= n_cys_x)
+        if cum_exceed[-1] >= min_exceedances:
+            stop = int(np.searchsorted(cum_exceed, min_exceedances)) + 1
+            ls_n_intersection.extend(n_intersect[:stop].tolist())
+            n_exceed = min_exceedances
+            break
+        ls_n_intersection.extend(n_intersect.tolist())
+        n_exceed = int(cum_exceed[-1])
+
+    n_used = len(ls_n_intersection)
+    if n_exceed >= min_exceedances:
+        pval = min_exceedances / n_used
+    else:
+        pval = (n_exceed + 1) / (n_used + 1)
+    return ls_n_intersection, pval
+
+
+# state shared by the sets scored in one worker process, set by the pool initializer
+_worker_state = {}
+
+
+def _init_permutation_worker(state):
+    _worker_state.clear()
+    _worker_state.update(state)
+
+
+def _permute_set_batch(task):
+    # score one batch of sets, each against its own Generator stream, so the
+    # result of a set does not depend on which worker or batch it lands in
+    ls_n_cys_x, ls_seed_seq = task
+    st = _worker_state
+    # (wall, CPU) seconds per stage, which StageTimings cannot see from the
+    # parent; adaptive permutation interleaves drawing and scoring, and is
+    # counted as permutation like the serial path
+    times = {'permutation': [0.0, 0.0], 'pvalue': [0.0, 0.0]}
+
+    def clock(name, wall0, cpu0):
+        times[name][0] += time.perf_counter() - wall0
+        times[name][1] += time.thread_time() - cpu0
+        return time.perf_counter(), time.thread_time()
+
+    results = []
+    for n_cys_x, seed_seq in zip(ls_n_cys_x, ls_seed_seq):
+        rng = np.random.default_rng(seed_seq)
+        t0 = time.perf_counter(), time.thread_time()
+        if st['adaptive']:
+            n_intersect, pval = sequential_null_intersections(
+                st['S_cys_inAnno'], st['S_bg_inAnno'], n_cys_x, st['n_perm'],
+                st['size_per_perm'], st['engine'], st['fg_mask'],
+                st['perm_step'], st['min_exceedances'], rng)
+            results.append((np.asarray(n_intersect, dtype=st['count_dtype']), pval))
+            clock('permutation', *t0)
+        else:
+            null = fit_null_density(draw_null_intersections(
+                st['S_cys_inAnno'], st['S_bg_inAnno'], st['n_perm'],
+                st['size_per_perm'], st['engine'], st['fg_mask'], rng))
+            t0 = clock('permutation', *t0)
+            # only the counts travel back, in the dtype of the PermutationStore;
+            # the KDE is not needed after scoring
+            results.append((np.asarray(null['ls_n_intersection'], dtype=st['count_dtype']),) +
+                           score_against_null(null, n_cys_x, st['log_offset'], st['kde_backend']))
+            clock('pvalue', *t0)
+    return results, {name: tuple(t) for name, t in times.items() if t[0] > 0}
+
+
+def _pool_context():
+    # forking while other threads hold locks (a web worker running several
+    # jobs) can deadlock the children, so pools started off the main thread
+    # come from a forkserver instead
+    if threading.current_thread() is threading.main_thread():
+        return None
+    return multiprocessing.get_context('forkserver')
+
+
+def permute_sets_parallel(ls_n_cys_x, state, seed: int, batch_size: int, n_workers: int,
+                          progress_callback=None):
+    # set i always draws from child i of SeedSequence(seed); batches of
+    # batch_size sets are the unit handed to the process pool. Yields
+    # (index of the first set, batch results, per-stage worker times) as
+    # batches finish, so the caller can store each one without holding every
+    # set's null at once.
+    ls_seed_seq = np.random.SeedSequence(seed).spawn(len(ls_n_cys_x))
+    starts = range(0, len(ls_n_cys_x), batch_size)
+    tasks = [
+        (ls_n_cys_x[start:start + batch_size], ls_seed_seq[start:start + batch_size])
+        for start in starts
+    ]
+    if n_workers <= 1:
+        _init_permutation_worker(state)
+        for n_done, (start, task) in enumerate(zip(starts, tasks), 1):
+            yield (start,) + _permute_set_batch(task)
+            if progress_callback is not None:
+                progress_callback(n_done / len(tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=_pool_context(),
+                                 initializer=_init_permutation_worker,
+                                 initargs=(state,)) as executor:
+            batches = executor.map(_permute_set_batch, tasks)
+            for n_done, (start, (batch, times)) in enumerate(zip(starts, batches), 1):
+                yield start, batch, times
+                if progress_callback is not None:
+                    progress_callback(n_done / len(tasks))
+
+
+class PermutationStore:
+    # Null counts for every set in one (n_sets, n_perm) integer matrix of the
+    # smallest dtype that holds the largest possible count, with per-set scalar
+    # summaries beside it. In shared mode all sets point at a single row.
+    # Above spill_threshold_bytes the matrix is a memory-mapped file in
+    # spill_dir, unlinked right away so it disappears with the mapping.
+
+    def __init__(self, n_sets: int, n_perm: int, max_count: int, shared: bool = False,
+                 spill_dir: str = None, spill_threshold_bytes: int = 1 << 30):
+        dtype = np.min_scalar_type(max(int(max_count), 0))
+        shape = (1 if shared else n_sets, n_perm)
+        self.shared = shared
+        if spill_dir is not None and shape[0] * shape[1] * dtype.itemsize > spill_threshold_bytes:
+            os.makedirs(spill_dir, exist_ok=True)
+            fd, fp = tempfile.mkstemp(dir=spill_dir, suffix='.perm')
+            os.close(fd)
+            self.counts = np.memmap(fp, dtype=dtype, mode='w+', shape=shape)
+            os.remove(fp)
+        else:
+            self.counts = np.zeros(shape, dtype=dtype)
+        self.n_perm_used = np.zeros(n_sets, dtype=np.int32)
+        self.null_median = np.full(n_sets, np.nan)
+        self.len_bin_midpoints = np.zeros(n_sets, dtype=np.int32)
+        self.integral = np.full(n_sets, np.nan)
+        self.integral_err = np.full(n_sets, np.nan)
+        self.p = np.full(n_sets, np.nan)
+        self.neg_log10p = np.full(n_sets, np.nan)
+
+    def _row(self, i: int) -> int:
+        return 0 if self.shared else i
+
+    def set_null(self, i: int, n_intersect):
+        n_intersect = np.asarray(n_intersect)
+        self.counts[self._row(i), :len(n_intersect)] = n_intersect
+        self.n_perm_used[i] = len(n_intersect)
+        self.null_median[i] = np.median(n_intersect) if len(n_intersect) > 0 else np.nan
+
+    def null_counts(self, i: int) -> np.ndarray:
+        return self.counts[self._row(i), :self.n_perm_used[i]]
+
+    def set_score(self, i: int, integral_val, pval, neglog10p, len_bin_midpoints: int = 0):
+        self.integral[i], self.integral_err[i] = integral_val
+        self.p[i] = pval
+        self.neg_log10p[i] = neglog10p
+        self.len_bin_midpoints[i] = len_bin_midpoints
+
+
 def perform_permutation(df,
                         S_cys_inAnno,
                         S_bg_inAnno,
@@ -71,124 +410,320 @@ def perform_permutation(df,
                         seed: int = 42,
                         batch_size: int = 250,
                         return_all: bool = False,
+                        engine: str = 'vectorized',
+                        null_mode: str = 'per_set',
+                        kde_backend: str = 'quad',
+                        compare_quad: bool = False,
+                        adaptive: bool = False,
+                        perm_step: int = 50,
+                        min_exceedances: int = 10,
+                        n_workers: int = None,
+                        null_library=None,
+                        shared_nulls: dict = None,
+                        progress_callback=None,
+                        timings=None,
+                        return_store: bool = False,
+                        spill_dir: str = None,
                         ):
-    pd.options.mode.chained_assignment = None
+    if engine not in ('loop', 'vectorized'):
+        raise ValueError(f"Unknown permutation engine: {engine}")
+    if null_mode not in ('per_set', 'shared'):
+        raise ValueError(f"Unknown null mode: {null_mode}")
+    if kde_backend not in ('quad', 'closed_form'):
+        raise ValueError(f"Unknown KDE backend: {kde_backend}")
+    if adaptive and null_mode != 'per_set':
+        raise ValueError("Adaptive permutation requires null_mode='per_set'")
+
     np.random.seed(seed)
+    if timings is None:
+        timings = StageTimings()
 
-    df = df.copy()
-    size_df = df.shape[0]
-
-    df[f'ls_n_intersection_{n_perm}'] = [None] * size_df
-    df[f'hist_{n_perm}'] = [None] * size_df
-    df[f'bin_edges_{n_perm}'] = [None] * size_df
-    df[f'hist_n_perm_{n_perm}'] = [None] * size_df
-    df[f'bin_midpoints_{n_perm}'] = [None] * size_df
-    df[f'len_bin_midpoints_{n_perm}'] = [None] * size_df
-    df[f'kde_{n_perm}'] = [None] * size_df
-    df[f'integral_{n_perm}'] = [None] * size_df
-    df[f'p_{n_perm}'] = [None] * size_df
-    df[f'neg_log10p_{n_perm}'] = [None] * size_df
-
-    for start in range(0, size_df, batch_size):
-        end = min(start + batch_size, size_df)
-        chunk = df.iloc[start:end].copy()
-
-        chunk_ls_n_intersection = []
-        chunk_hist = []
-        chunk_bin_edges = []
-        chunk_bin_midpoints = []
-        chunk_hist_n_perm = []
-        chunk_len_bin_midpoints = []
-        chunk_kde = []
-        chunk_integral = []
-        chunk_pval = []
-        chunk_neglog10p = []
-
-        for idx, row in chunk.iterrows():
-            random_draws = np.random.choice(S_bg_inAnno, (n_perm, size_per_perm), replace=True)
-            n_intersect = [
-                len(set(random_draws[j]).intersection(S_cys_inAnno))
-                for j in range(n_perm)
-            ]
-
-            chunk_ls_n_intersection.append(n_intersect)
-
-            hist_vals, bin_edges = np.histogram(n_intersect, bins='auto', density=True)
-            chunk_hist.append((hist_vals, bin_edges))
-            chunk_bin_edges.append(bin_edges)
-            chunk_hist_n_perm.append(hist_vals)
-
-            bin_mids = calculate_bin_midpoints(bin_edges)
-            chunk_bin_midpoints.append(bin_mids)
-            chunk_len_bin_midpoints.append(len(bin_mids))
-
-            if len(bin_mids) <= 2:
-                chunk_kde.append(np.NaN)
-                chunk_integral.append((np.NaN, np.NaN))
-                chunk_pval.append(np.NaN)
-                chunk_neglog10p.append(np.NaN)
+    fg_mask = encode_foreground_mask(S_bg_inAnno, S_cys_inAnno)
+    n_sets = df.shape[0]
+    store = PermutationStore(
+        n_sets, n_perm, min(size_per_perm, int(fg_mask.sum())),
+        shared=(null_mode == 'shared'), spill_dir=spill_dir)
+    if engine != 'vectorized':
+        fg_mask = None
+    ls_n_cys_x = df['n_cys_x_set'].tolist()
+
+    # with n_workers set, every set gets its own Generator stream spawned from
+    # seed, which keeps results identical for any worker count or batch_size
+    parallel = n_workers is not None and null_mode == 'per_set'
+    quad_diff = np.full(n_sets, np.nan) if compare_quad else None
+    if parallel:
+        state = {
+            'S_cys_inAnno': S_cys_inAnno,
+            'S_bg_inAnno': S_bg_inAnno,
+            'fg_mask': fg_mask,
+            'n_perm': n_perm,
+            'size_per_perm': size_per_perm,
+            'engine': engine,
+            'log_offset': log_offset,
+            'kde_backend': kde_backend,
+            'adaptive': adaptive,
+            'perm_step': perm_step,
+            'min_exceedances': min_exceedances,
+            'count_dtype': store.counts.dtype,
+        }
+        # drawing and scoring happen together in the workers, which time the
+        # two stages apart; each batch goes into the store as soon as it arrives
+        with timings.parallel_stages() as report:
+            for start, batch, times in permute_sets_parallel(
+                    ls_n_cys_x, state, seed, batch_size, n_workers, progress_callback):
+                report(times)
+                for i, result in enumerate(batch, start):
+                    store.set_null(i, result[0])
+                    if adaptive:
+                        pval = result[1]
+                        store.set_score(i, (np.NaN, np.NaN), pval, -np.log10(pval + log_offset))
+                        continue
+                    store.set_score(i, *result[1:])
+                    if compare_quad:
+                        null = fit_null_density(store.null_counts(i))
+                        _, pval_quad, _ = score_against_null(null, ls_n_cys_x[i], log_offset, 'quad')
+                        quad_diff[i] = result[2] - pval_quad
+
+    # the null only depends on the two cysteine lists and size_per_perm, so in
+    # shared mode it is drawn and fitted once and every set is scored against it
+    shared_null = None
+    shared_scores = {}
+    with timings.stage('permutation'):
+        if null_mode == 'shared':
+            # look the null up by the counts it depends on before permuting
+            n_fg = int(encode_foreground_mask(S_bg_inAnno, S_cys_inAnno).sum())
+            # shared_nulls holds nulls already fitted by the caller, keyed by
+            # (n_bg, n_fg, size_per_perm, n_perm, seed)
+            null_sizes = (len(S_bg_inAnno), n_fg, size_per_perm, n_perm, seed)
+            if shared_nulls is not None and null_sizes in shared_nulls:
+                shared_null = shared_nulls[null_sizes]
+            elif null_library is not None:
+                shared_null = null_library.get_null(len(S_bg_inAnno), n_fg, size_per_perm, n_perm, seed)
+            else:
+                shared_null = fit_null_density(compute_null_counts(
+                    len(S_bg_inAnno), n_fg, size_per_perm, n_perm, seed, engine))
+    if null_mode == 'shared' and kde_backend == 'closed_form':
+        with timings.stage('pvalue'):
+            shared_scores = score_many_against_null(shared_null, sorted(set(ls_n_cys_x)), log_offset)
+
+    # the sequential path; the parallel one has already filled the store
+    for i, n_cys_x in enumerate([] if parallel else ls_n_cys_x):
+        if adaptive:
+            # n_perm is the upper bound; each set stops as soon as its p-value is settled
+            with timings.stage('permutation'):
+                n_intersect, pval = sequential_null_intersections(
+                    S_cys_inAnno, S_bg_inAnno, n_cys_x, n_perm, size_per_perm,
+                    engine, fg_mask, perm_step, min_exceedances)
+            store.set_null(i, n_intersect)
+            store.set_score(i, (np.NaN, np.NaN), pval, -np.log10(pval + log_offset))
+        else:
+            if null_mode == 'shared':
+                null = shared_null
+                n_intersect = null['ls_n_intersection']
+                if n_cys_x not in shared_scores:
+                    with timings.stage('pvalue'):
+                        shared_scores[n_cys_x] = score_against_null(null, n_cys_x, log_offset, kde_backend)
+                integral_val, pval, neglog10p = shared_scores[n_cys_x]
+            else:
+                with timings.stage('permutation'):
+                    null = fit_null_density(draw_null_intersections(
+                        S_cys_inAnno, S_bg_inAnno, n_perm, size_per_perm, engine, fg_mask))
+                n_intersect = null['ls_n_intersection']
+                with timings.stage('pvalue'):
+                    integral_val, pval, neglog10p = score_against_null(null, n_cys_x, log_offset, kde_backend)
+
+            if null_mode == 'shared' and i > 0:
+                store.n_perm_used[i] = store.n_perm_used[0]
+                store.null_median[i] = store.null_median[0]
             else:
-                kde_fit = gaussian_kde(n_intersect)
-                chunk_kde.append(kde_fit)
-                n_cys_x = row['n_cys_x_set']
-                integral_val = quad(kde_fit, n_cys_x, np.inf, epsrel=1e-4, epsabs=1e-6)
-                chunk_integral.append(integral_val)
-
-                pval = integral_val[0]
-                chunk_pval.append(pval)
-                chunk_neglog10p.append(-np.log10(pval + log_offset))
-
-        chunk[f'ls_n_intersection_{n_perm}'] = chunk_ls_n_intersection
-        chunk[f'hist_{n_perm}'] = chunk_hist
-        chunk[f'bin_edges_{n_perm}'] = chunk_bin_edges
-        chunk[f'hist_n_perm_{n_perm}'] = chunk_hist_n_perm
-        chunk[f'bin_midpoints_{n_perm}'] = chunk_bin_midpoints
-        chunk[f'len_bin_midpoints_{n_perm}'] = chunk_len_bin_midpoints
-        chunk[f'kde_{n_perm}'] = chunk_kde
-        chunk[f'integral_{n_perm}'] = chunk_integral
-        chunk[f'p_{n_perm}'] = chunk_pval
-        chunk[f'neg_log10p_{n_perm}'] = chunk_neglog10p
-
-        df.iloc[start:end] = chunk
-
-    if not return_all:
+                store.set_null(i, n_intersect)
+            if compare_quad:
+                # debug: how far the selected backend is from the quad integral
+                _, pval_quad, _ = score_against_null(null, n_cys_x, log_offset, 'quad')
+                quad_diff[i] = pval - pval_quad
+            store.set_score(i, integral_val, pval, neglog10p, len(null['bin_midpoints']))
+
+        if progress_callback is not None and ((i + 1) % batch_size == 0 or i + 1 == n_sets):
+            progress_callback((i + 1) / n_sets)
+
+    df = df.copy()
+    df[f'p_{n_perm}'] = store.p
+    df[f'neg_log10p_{n_perm}'] = store.neg_log10p
+    df[f'null_median_{n_perm}'] = store.null_median
+    if adaptive:
+        df['n_perm_used'] = store.n_perm_used
+    if compare_quad:
+        df[f'p_quad_diff_{n_perm}'] = quad_diff
+    if return_all:
+        df[f'integral_{n_perm}'] = store.integral
+        df[f'integral_err_{n_perm}'] = store.integral_err
+        df[f'len_bin_midpoints_{n_perm}'] = store.len_bin_midpoints
+        if not adaptive:
+            df['n_perm_used'] = store.n_perm_used
+    else:
         cols = [
             'set_name',
             'set_type',
             'n_cys_x_set',
             'ls_cys_inSet',
-            f'ls_n_intersection_{n_perm}',
+            f'null_median_{n_perm}',
             f'p_{n_perm}',
             f'neg_log10p_{n_perm}',
         ]
-        return df[cols].copy()
+        if adaptive:
+            cols.append('n_perm_used')
+        if compare_quad:
+            cols.append(f'p_quad_diff_{n_perm}')
+        df = df[cols].copy()
 
+    if return_store:
+        return df, store
     return df
 
-def generate_feature_plot(df, fpout:str, p_final:float=0.05) -> str:
-    df = df[df['p_final'] < 0.05].copy()
-    if df.shape[0] == 0:
-        return None
-    
-    df["-log10p"] = df['p_final'].apply(lambda x: -np.log10(x))
+@lru_cache(maxsize=128)
+def exact_null_pmf(n_bg: int, n_fg: int, size_per_perm: int, tol: float = 1e-300):
+    # Distribution of the number of distinct foreground cysteines hit by
+    # size_per_perm draws with replacement from n_bg background cysteines, of
+    # which n_fg are foreground. The number of draws landing in the foreground
+    # is Binomial(size_per_perm, n_fg / n_bg); given j such draws, each one hits
+    # a new foreground cysteine with probability (n_fg - d) / n_fg.
+    n_max = min(n_fg, size_per_perm)
+    if n_fg == 0 or size_per_perm == 0:
+        return np.array([1.0])
+
+    with np.errstate(divide='ignore', under='ignore'):
+        binom_pmf = binom.pmf(np.arange(size_per_perm + 1), size_per_perm, n_fg / n_bg)
+    j_support = np.flatnonzero(binom_pmf > tol)
+    j_lo, j_hi = j_support[0], j_support[-1]
+
+    pmf = np.zeros(n_max + 1)
+    occupancy = np.zeros(n_max + 1)
+    occupancy[0] = 1.0
+    p_new = (n_fg - np.arange(n_max + 1)) / n_fg
+    lo, hi = 0, 0
+    for j in range(j_hi + 1):
+        if j >= j_lo:
+            pmf[lo:hi + 1] += binom_pmf[j] * occupancy[lo:hi + 1]
+        if j == j_hi:
+            break
+        # advance the occupancy chain by one foreground draw, only over the
+        # window of states that still carry non-negligible mass
+        new_hi = min(hi + 1, n_max)
+        moved = occupancy[lo:new_hi] * p_new[lo:new_hi]
+        occupancy[lo:hi + 1] -= occupancy[lo:hi + 1] * p_new[lo:hi + 1]
+        if new_hi > hi:
+            occupancy[new_hi] = 0.0
+        occupancy[lo + 1:new_hi + 1] += moved
+        hi = new_hi
+        alive = np.flatnonzero(occupancy[lo:hi + 1] > tol)
+        occupancy[lo:lo + alive[0]] = 0.0
+        occupancy[lo + alive[-1] + 1:hi + 1] = 0.0
+        lo, hi = lo + alive[0], lo + alive[-1]
+
+    return pmf / pmf.sum()
+
+
+def exact_null_median(pmf):
+    return int(np.searchsorted(np.cumsum(pmf), 0.5))
+
+
+def exact_pvalues(n_cys_x, n_bg: int, n_fg: int, size_per_perm: int):
+    pmf = exact_null_pmf(n_bg, n_fg, size_per_perm)
+    # P(X >= x) for x = 0..len(pmf), with 0 beyond the support
+    sf = np.append(np.cumsum(pmf[::-1])[::-1], 0.0)
+    x = np.clip(np.asarray(n_cys_x, dtype=int), 0, len(pmf))
+    return np.clip(sf[x], 0.0, 1.0)
+
+
+def perform_exact(df,
+                  S_cys_inAnno,
+                  S_bg_inAnno,
+                  size_per_perm: int,
+                  log_offset: float = 0.0001):
+    df = df.copy()
+    n_bg = len(S_bg_inAnno)
+    n_fg = int(encode_foreground_mask(S_bg_inAnno, S_cys_inAnno).sum())
+
+    pmf = exact_null_pmf(n_bg, n_fg, size_per_perm)
+    df['p_exact'] = exact_pvalues(df['n_cys_x_set'].to_numpy(), n_bg, n_fg, size_per_perm)
+    df['neg_log10p_exact'] = -np.log10(df['p_exact'] + log_offset)
+    df['null_median_exact'] = exact_null_median(pmf)
+
+    cols = [
+        'set_name',
+        'set_type',
+        'n_cys_x_set',
+        'ls_cys_inSet',
+        'null_median_exact',
+        'p_exact',
+        'neg_log10p_exact',
+    ]
+    return df[cols].copy()
+
+def generate_feature_plot(df, fpout:str, p_final:float=0.05, fmt:str='png') -> str:
+    # matplotlib is only loaded by runs that draw a plot
+    from plotting import render_feature_plot
+    return render_feature_plot(df, fpout, fmt, p_final)
+
+SIDE_TABLE_FORMATS = ('csv', 'csv.gz', 'parquet')
+
+def write_side_table(S, fp_root: str, table_format: str = 'csv') -> str:
+    # the not-in-annotation lists can be as large as the background, so they
+    # can be written gzip-compressed or as Parquet (needs pyarrow)
+    fp = f"{fp_root}.{table_format}"
+    if table_format == 'parquet':
+        S.to_frame(name=str(S.name if S.name is not None else 0)).to_parquet(fp, index=False)
+    elif table_format == 'csv.gz':
+        S.to_csv(fp, header=True, index=False, compression='gzip')
+    else:
+        S.to_csv(fp, header=True, index=False)
+    return fp
 
-    fig, ax = plt.subplots(figsize=(5, 5))
-    df[['set_name', '-log10p']].set_index('set_name').head(20) \
-        .sort_values('-log10p', ascending=True) \
-        .plot(kind='barh', ax=ax, color='skyblue')
+def intersecting_sets(fp_anno, fp_anno_index, vocab: CysVocabulary, S_cys_inAnno) -> pd.DataFrame:
+    # annotation sets with at least one annotated foreground cysteine, with
+    # their member lists and overlap counts
+    if fp_anno_index is not None:
+        # precompiled sparse index: overlap counts are one mat-vec, and member
+        # lists are only materialised for the sets that intersect
+        anno_index = load_annotation_index(fp_anno_index)
+        n_cys_x_set = count_set_overlaps(anno_index, vocab.decode(S_cys_inAnno))
+        rows = np.flatnonzero(n_cys_x_set > 0)
+        return pd.DataFrame({
+            'set_name': anno_index['set_name'][rows],
+            'set_type': anno_index['set_type'][rows],
+            'ls_cys_inSet': set_members(anno_index, rows),
+            'n_cys_x_set': n_cys_x_set[rows],
+        })
 
-    plt.title('Cysteine Enrichment Analysis')
-    plt.xlabel('-log10(p)')
-    plt.ylabel(f'Enriched Features (upto Top 20)')
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", dpi=300, bbox_inches='tight')
-    buf.seek(0)
-    image_data = buf.getvalue()
+    df_annotation_sub = pd.read_csv(fp_anno, header=0, index_col=0)
+    df_table = df_annotation_sub[['set_name', 'set_type', 'cys']].copy()
+    df_table['ls_cys_inSet'] = df_table['cys'].str.split(',')
+    df_table['n_cys_x_set'] = count_member_overlaps(df_table['ls_cys_inSet'], vocab, vocab.mask(S_cys_inAnno))
+    return df_table[df_table['n_cys_x_set'] > 0].copy()
 
-    with open(fpout, 'wb') as f:
-        f.write(image_data)
 
-    return fpout
+def drop_excluded_sets(df):
+    # "protein modifying enzyme" sets are scored with the rest but not reported
+    return df[~df['set_name'].str.contains('protein modifying enzyme', case=False, na=False)]
+
+
+def summarize_replicates(dict_df_seed, fdr_threshold: float = 0.05):
+    # one row per set: spread of p_final and enrichment across seeds, plus the
+    # fraction of seeds in which the set passes the FDR threshold
+    df = pd.concat(dict_df_seed, names=['seed', 'row'])
+    df['significant'] = df['fdr'] < fdr_threshold
+    grouped = df.groupby(level='row')
+    df_summary = grouped[['set_name', 'set_type', 'n_cys_x_set']].first()
+    df_summary['n_seeds'] = grouped.size()
+    df_summary['p_mean'] = grouped['p_final'].mean()
+    df_summary['p_std'] = grouped['p_final'].std(ddof=0)
+    df_summary['p_min'] = grouped['p_final'].min()
+    df_summary['p_max'] = grouped['p_final'].max()
+    df_summary['fdr_mean'] = grouped['fdr'].mean()
+    df_summary['enrichment_score_mean'] = grouped['enrichment_score'].mean()
+    df_summary['enrichment_score_std'] = grouped['enrichment_score'].std(ddof=0)
+    df_summary['frac_significant'] = grouped['significant'].mean()
+    return df_summary.sort_values('enrichment_score_mean', ascending=False)
 
 def run_csea_analysis(fp_cys, 
                         fp_bg, 
@@ -198,7 +733,36 @@ def run_csea_analysis(fp_cys,
                         n_perm: int = 500, 
                         batch_size:int = 25,
                         seed: int = 34,
-                        return_df: bool = False):
+                        return_df: bool = False,
+                        engine: str = 'vectorized',
+                        null_mode: str = 'per_set',
+                        pvalue_mode: str = 'permutation',
+                        kde_backend: str = 'quad',
+                        compare_quad: bool = False,
+                        adaptive: bool = False,
+                        fp_anno_index: str = None,
+                        n_workers: int = None,
+                        seeds: list = None,
+                        null_library=None,
+                        shared_nulls: dict = None,
+                        progress_callback=None,
+                        timings=None,
+                        side_table_format: str = 'csv',
+                        plot_format: str = 'png',
+                        inputs: dict = None,
+                        spill_dir: str = None):
+    if pvalue_mode not in ('permutation', 'exact'):
+        raise ValueError(f"Unknown p-value mode: {pvalue_mode}")
+    if side_table_format not in SIDE_TABLE_FORMATS:
+        raise ValueError(f"Unknown side table format: {side_table_format}")
+    if pvalue_mode == 'exact':
+        null_mode = 'exact'
+
+    # replicate seeds share everything up to the scoring stage; the first one
+    # is the primary run whose table, plot and file names match a single run
+    ls_seeds = [seed] if not seeds else [int(s) for s in seeds]
+    seed = ls_seeds[0]
+
     fn_root = re.split('/', fp_cys)[-1][:-4]
     print(f"Processing {fn_root}...")
     print("Starting CSEA analysis...")
@@ -208,27 +772,36 @@ def run_csea_analysis(fp_cys,
     np.random.seed(seed)
 
     ret = {}
+    if timings is None:
+        timings = StageTimings()
 
-    df_annotation_sub = pd.read_csv(fp_anno, header=0, index_col=0)
-    ls_bgcys_anno = pd.read_csv(fp_anno_bgcys, header=None)[0].to_list()
+    with timings.stage('annotation_intersection'):
+        ls_bgcys_anno = read_annotation_background(fp_anno_bgcys)
+
+        if inputs is None:
+            inputs = load_inputs(fp_cys, fp_bg)
+        S_cys, S_bg, malformed = inputs['S_cys'], inputs['S_bg'], inputs['malformed']
 
-    S_cys, S_bg = get_input_and_bg_cys(fp_cys, fp_bg)
-    S_cys_inAnno = get_annotated_cys(S_cys, ls_bgcys_anno)
-    S_bg_inAnno = get_annotated_cys(S_bg, ls_bgcys_anno)
+        # every later stage works on integer codes from one shared vocabulary;
+        # S_cys_inAnno and S_bg_inAnno hold unique codes in code order
+        vocab = inputs['vocab']
+        codes_cys, codes_bg = inputs['codes_cys'], inputs['codes_bg']
+        anno_mask, S_cys_inAnno, S_bg_inAnno = annotate_inputs(inputs, ls_bgcys_anno)
 
     ret['size_permutation'] = len(S_cys_inAnno)
     ret['n_Anno_inSet'] = len(ls_bgcys_anno)
     ret['n_cys_input']  = len(S_cys)
     ret['n_bg_input'] = len(S_bg)
-    ret['n_cys_notinAnno'] = len(S_cys) - len(S_cys_inAnno)
+    n_cys_anno = len(annotated_codes(codes_cys, anno_mask))
+    ret['n_cys_notinAnno'] = len(S_cys) - n_cys_anno
+    ret['n_cys_notinBg'] = n_cys_anno - len(S_cys_inAnno)
     ret['n_bg_notinAnno'] = len(S_bg) - len(S_bg_inAnno)
+    ret.update(malformed)
+    ret['null_mode'] = null_mode
+    ret['pvalue_mode'] = pvalue_mode
 
-    df_table = df_annotation_sub[['set_name', 'set_type', 'cys']].copy()
-    df_table['ls_cys_inSet'] = df_table['cys'].str.split(',')
-    df_table['n_cys_x_set'] = df_table['ls_cys_inSet'].apply(
-        lambda x: len(set(x).intersection(S_cys_inAnno))
-    )
-    df_res_X = df_table[df_table['n_cys_x_set'] > 0].copy()
+    with timings.stage('annotation_intersection'):
+        df_res_X = intersecting_sets(fp_anno, fp_anno_index, vocab, S_cys_inAnno)
 
     print(f"Number of sets that intersect: {df_res_X.shape[0]}")
 
@@ -236,37 +809,82 @@ def run_csea_analysis(fp_cys,
     n_feature = len(df_res_X)
     log_offset = 0.0001
 
-    print("Perform permutation...")
-    df_res_X = perform_permutation(
-        df_res_X,
-        S_cys_inAnno,
-        S_bg_inAnno,
-        n_feature,
-        n_perm,
-        size_per_perm,
-        log_offset,
-        seed=seed,
-        return_all=False
-    )
+    df_sets = df_res_X
 
-    df_res_X['p_final'] = df_res_X[f'p_{n_perm}']
-    df_res_X['ls_n_intersection_final'] = df_res_X[f'ls_n_intersection_{n_perm}']
+    def score_replicate(rep_seed, replicate_progress=None):
+        np.random.seed(rep_seed)
+        if pvalue_mode == 'exact':
+            print("Compute exact p-values...")
+            with timings.stage('pvalue'):
+                df_rep = perform_exact(
+                    df_sets,
+                    S_cys_inAnno,
+                    S_bg_inAnno,
+                    size_per_perm,
+                    log_offset,
+                )
+            df_rep['p_final'] = df_rep['p_exact']
+            df_rep['null_median'] = df_rep['null_median_exact']
+        else:
+            print("Perform permutation...")
+            df_rep = perform_permutation(
+                df_sets,
+                S_cys_inAnno,
+                S_bg_inAnno,
+                n_feature,
+                n_perm,
+                size_per_perm,
+                log_offset,
+                seed=rep_seed,
+                return_all=False,
+                engine=engine,
+                null_mode=null_mode,
+                kde_backend=kde_backend,
+                compare_quad=compare_quad,
+                batch_size=batch_size,
+                adaptive=adaptive,
+                n_workers=n_workers,
+                null_library=null_library,
+                shared_nulls=shared_nulls,
+                progress_callback=replicate_progress,
+                timings=timings,
+                spill_dir=spill_dir,
+            )
+            df_rep['p_final'] = df_rep[f'p_{n_perm}']
+            if compare_quad:
+                df_rep['p_quad_diff'] = df_rep[f'p_quad_diff_{n_perm}']
+            df_rep['null_median'] = df_rep[f'null_median_{n_perm}']
 
-    df_res_X['enrichment_score'] = df_res_X.apply(
-        lambda x: (x['n_cys_x_set'] + 1)
-                  / (np.nanmedian(x['ls_n_intersection_final']) + 1),
-        axis=1
-    )
+        with timings.stage('fdr'):
+            df_rep['enrichment_score'] = (df_rep['n_cys_x_set'] + 1) / (df_rep['null_median'] + 1)
+
+            _, fdr_array, _, _ = multipletests(df_rep['p_final'], method='fdr_bh')
+            df_rep['fdr'] = fdr_array
+        df_rep['null_mode'] = null_mode
+
+        return df_rep
 
-    _, fdr_array, _, _ = multipletests(df_res_X['p_final'], method='fdr_bh')
-    df_res_X['fdr'] = fdr_array
+    dict_df_seed = {}
+    for i_rep, rep_seed in enumerate(ls_seeds):
+        if len(ls_seeds) > 1:
+            print(f"Replicate seed {rep_seed}...")
+        replicate_progress = None
+        if progress_callback is not None:
+            replicate_progress = lambda f, i_rep=i_rep: progress_callback((i_rep + f) / len(ls_seeds))
+        if pvalue_mode == 'exact' and dict_df_seed:
+            # the exact null does not depend on the seed
+            dict_df_seed[rep_seed] = dict_df_seed[seed]
+        else:
+            dict_df_seed[rep_seed] = score_replicate(rep_seed, replicate_progress)
+        if progress_callback is not None:
+            progress_callback((i_rep + 1) / len(ls_seeds))
+    df_res_X = dict_df_seed[seed].copy()
 
     df_res_X = df_res_X.sort_values('enrichment_score', ascending=False)
     df_res_X['n_cys_inSet'] = df_res_X['ls_cys_inSet'].apply(len)
+    df_scored = df_res_X
 
-    df_res_X = df_res_X[
-        ~df_res_X['set_name'].str.contains('protein modifying enzyme', case=False, na=False)
-    ]
+    df_res_X = drop_excluded_sets(df_res_X)
 
     cols_final = [
         'set_name',
@@ -275,41 +893,586 @@ def run_csea_analysis(fp_cys,
         'n_cys_x_set',
         'p_final',
         'fdr',
-        'enrichment_score'
+        'enrichment_score',
+        'null_mode',
     ]
+    if 'p_quad_diff' in df_res_X.columns:
+        cols_final.append('p_quad_diff')
+    if null_library is not None:
+        ret['null_library_hits'] = null_library.hits
+        ret['null_library_misses'] = null_library.misses
+    if 'n_perm_used' in df_res_X.columns:
+        cols_final.append('n_perm_used')
+        ret['n_perm_used_total'] = int(df_res_X['n_perm_used'].sum())
 
     print("Save output...")
     fp = f"{output_dir}/result_{fn_root}_seed{seed}.csv"
     df_res_X[cols_final].to_csv(fp, header=True, index=False)
     print(f"Saved results to {fp}")
 
-    fp = f"{output_dir}/result_{fn_root}_seed{seed}_cys_notinAnno.csv"
-    S_cys[~S_cys.isin(S_cys_inAnno)].to_csv(fp, header=True, index=False)
+    if len(ls_seeds) > 1:
+        df_summary = drop_excluded_sets(summarize_replicates(dict_df_seed))
+        fp = f"{output_dir}/result_{fn_root}_replicates.csv"
+        df_summary.to_csv(fp, header=True, index=False)
+        print(f"Saved replicate summary for seeds {ls_seeds} to {fp}")
+        ret['seeds'] = ls_seeds
+        ret['n_sets_always_significant'] = int((df_summary['frac_significant'] == 1).sum())
+        ret['n_sets_sometimes_significant'] = int(df_summary['frac_significant'].between(0, 1, inclusive='neither').sum())
+        if return_df:
+            ret['df_replicates'] = df_summary.copy()
+
+    fp = f"{output_dir}/result_{fn_root}_seed{seed}_cys_notinAnno"
+    write_side_table(S_cys[~anno_mask[codes_cys]], fp, side_table_format)
 
-    fp = f"{output_dir}/result_{fn_root}_seed{seed}_bg_notinAnno.csv"
-    S_bg[~S_bg.isin(S_bg_inAnno)].to_csv(fp, header=True, index=False)
+    fp = f"{output_dir}/result_{fn_root}_seed{seed}_bg_notinAnno"
+    write_side_table(S_bg[~anno_mask[codes_bg]], fp, side_table_format)
 
     if return_df:
         ret['df'] = df_res_X[cols_final].copy()
+        # every scored set, for callers that adjust p-values across runs
+        # over the same sets the per-run FDR was computed on
+        ret['df_scored'] = df_scored[cols_final].copy()
 
-    fp_plot = f"{output_dir}/csea_barplot.png"
-    fp_plot = generate_feature_plot(df_res_X[cols_final].copy(), fp_plot)
+    # plot_format='none' skips rendering; 'json' writes a plot spec that the
+    # frontend can draw, or that can be rendered later on request
+    fp_plot = None
+    if plot_format != 'none':
+        with timings.stage('plotting'):
+            fp_plot = f"{output_dir}/csea_barplot.{plot_format}"
+            fp_plot = generate_feature_plot(df_res_X[cols_final].copy(), fp_plot, fmt=plot_format)
     ret['fp_plot'] = fp_plot
+    ret['stage_timings'] = timings.as_dict()
+
+    return ret
+
+
+def run_csea_all_annotations(fp_cys,
+                             fp_bg,
+                             annotations: dict,
+                             output_dir,
+                             n_perm: int = 500,
+                             seed: int = 34,
+                             return_df: bool = False,
+                             null_mode: str = 'per_set',
+                             null_library=None,
+                             progress_callback=None,
+                             timings=None,
+                             plot_format: str = 'png',
+                             **kwargs):
+    # Runs every annotation family in annotations ({family: {'fp_anno',
+    # 'fp_anno_bgcys', optionally 'fp_anno_index'}}) against inputs that are
+    # parsed and interned once. Each family writes its usual outputs to
+    # output_dir/<family>/; the combined table with FDR over all families,
+    # and its plot, go to output_dir.
+    if timings is None:
+        timings = StageTimings()
+    fn_root = re.split('/', fp_cys)[-1][:-4]
+    os.makedirs(output_dir, exist_ok=True)
+
+    with timings.stage('annotation_intersection'):
+        inputs = load_inputs(fp_cys, fp_bg)
+        dict_bgcys_anno = {
+            family: read_annotation_background(files['fp_anno_bgcys'])
+            for family, files in annotations.items()
+        }
+
+    # In shared mode every family's null is drawn up front from one block of
+    # uniform draws scaled to that family's annotated background, and kept in
+    # memory for the families' runs; a family gets the same null as when run
+    # on its own. per_set draws a null for every set, which is not shared.
+    shared_nulls = {}
+    if null_mode == 'shared' and kwargs.get('pvalue_mode', 'permutation') == 'permutation':
+        with timings.stage('permutation'):
+            ls_sizes = []
+            for ls_bgcys_anno in dict_bgcys_anno.values():
+                _, S_cys_inAnno, S_bg_inAnno = annotate_inputs(inputs, ls_bgcys_anno)
+                n_fg = int(encode_foreground_mask(S_bg_inAnno, S_cys_inAnno).sum())
+                ls_sizes.append((len(S_bg_inAnno), n_fg, len(S_cys_inAnno)))
+            if null_library is not None:
+                ls_null = null_library.get_nulls(ls_sizes, n_perm, seed)
+            else:
+                ls_null = [fit_null_density(n_intersect) for n_intersect in
+                           compute_null_counts_many(ls_sizes, n_perm, seed, kwargs.get('engine', 'vectorized'))]
+            for sizes, null in zip(ls_sizes, ls_null):
+                shared_nulls[(*sizes, n_perm, seed)] = null
+
+    ret = {'annotations': {}}
+    ls_df = []
+    for i_family, (family, files) in enumerate(annotations.items()):
+        print(f"Annotation family {family}...")
+        family_progress = None
+        if progress_callback is not None:
+            family_progress = lambda f, i=i_family: progress_callback((i + f) / len(annotations))
+        ret_family = run_csea_analysis(
+            fp_cys,
+            fp_bg,
+            files.get('fp_anno'),
+            dict_bgcys_anno[family],
+            os.path.join(output_dir, family),
+            n_perm=n_perm,
+            seed=seed,
+            return_df=True,
+            null_mode=null_mode,
+            fp_anno_index=files.get('fp_anno_index'),
+            null_library=null_library,
+            shared_nulls=shared_nulls,
+            progress_callback=family_progress,
+            timings=timings,
+            plot_format=plot_format,
+            inputs=inputs,
+            **kwargs,
+        )
+        ret_family.pop('df')
+        df_family = ret_family.pop('df_scored')
+        ret_family.pop('df_replicates', None)
+        ret_family.pop('stage_timings', None)
+        ret_family.pop('fp_plot', None)
+        ret['annotations'][family] = ret_family
+        df_family.insert(0, 'annotation', family)
+        ls_df.append(df_family)
+
+    # the combined FDR is adjusted over the same sets as each family's FDR,
+    # and the excluded sets are dropped afterwards as in a single run
+    with timings.stage('fdr'):
+        df_all = pd.concat(ls_df, ignore_index=True)
+        df_all = df_all.rename(columns={'fdr': 'fdr_family'})
+        df_all['fdr'] = np.nan
+        if len(df_all) > 0:
+            _, df_all['fdr'], _, _ = multipletests(df_all['p_final'], method='fdr_bh')
+        df_all = drop_excluded_sets(df_all).sort_values('enrichment_score', ascending=False)
+
+    # the _seed<n> suffix keeps the combined table where render_plot looks
+    fp = f"{output_dir}/result_{fn_root}_all_seed{seed}.csv"
+    df_all.to_csv(fp, header=True, index=False)
+    print(f"Saved combined results to {fp}")
+
+    fp_plot = None
+    if plot_format != 'none':
+        with timings.stage('plotting'):
+            fp_plot = generate_feature_plot(df_all.copy(), f"{output_dir}/csea_barplot.{plot_format}", fmt=plot_format)
+
+    ret['n_cys_input'] = len(inputs['S_cys'])
+    ret['n_bg_input'] = len(inputs['S_bg'])
+    ret.update(inputs['malformed'])
+    ret['n_sets_total'] = int(len(df_all))
+    if return_df:
+        ret['df'] = df_all.copy()
+    ret['fp_plot'] = fp_plot
+    ret['stage_timings'] = timings.as_dict()
+    return ret
+
+
+def score_sets_per_background(n_cys_x, ls_n_bg, ls_n_fg, size_per_perm,
+                              n_perm: int = 500,
+                              pvalue_mode: str = 'permutation',
+                              kde_backend: str = 'quad',
+                              rng=None,
+                              timings=None,
+                              progress_callback=None):
+    # (n_sets, n_backgrounds) p-values and the null median per background.
+    # n_cys_x holds the overlap counts, either one per set for every
+    # background or (n_sets, n_backgrounds); size_per_perm is one draw size or
+    # one per background. Each background needs one null, scored at its
+    # distinct overlap counts.
+    if timings is None:
+        timings = StageTimings()
+    n_backgrounds = len(ls_n_bg)
+    n_cys_x = np.asarray(n_cys_x, dtype=int)
+    if n_cys_x.ndim == 1:
+        n_cys_x = np.repeat(n_cys_x[:, None], n_backgrounds, axis=1)
+    ls_size = np.broadcast_to(np.asarray(size_per_perm, dtype=int), (n_backgrounds,))
+    pvals = np.full(n_cys_x.shape, np.nan)
+    null_median = np.full(n_backgrounds, np.nan)
+
+    if pvalue_mode == 'permutation':
+        with timings.stage('permutation'):
+            counts = draw_null_intersections_per_background(ls_n_bg, ls_n_fg, n_perm, ls_size, rng)
+
+    for j in range(n_backgrounds):
+        x_unique, x_inverse = np.unique(n_cys_x[:, j], return_inverse=True)
+        with timings.stage('pvalue'):
+            if pvalue_mode == 'exact':
+                pvals[:, j] = exact_pvalues(x_unique, ls_n_bg[j], ls_n_fg[j], ls_size[j])[x_inverse]
+                null_median[j] = exact_null_median(exact_null_pmf(ls_n_bg[j], ls_n_fg[j], ls_size[j]))
+            else:
+                null = fit_null_density(counts[j])
+                if kde_backend == 'closed_form':
+                    scores = score_many_against_null(null, x_unique)
+                else:
+                    scores = {x: score_against_null(null, x, kde_backend=kde_backend) for x in x_unique}
+                pvals[:, j] = np.array([scores[x][1] for x in x_unique])[x_inverse]
+                null_median[j] = np.median(counts[j])
+        if progress_callback is not None:
+            progress_callback((j + 1) / n_backgrounds)
+    return pvals, null_median
+
 
+def run_csea_per_tissue(fp_cys,
+                        backgrounds: dict,
+                        fp_anno,
+                        fp_anno_bgcys,
+                        output_dir,
+                        n_perm: int = 500,
+                        seed: int = 34,
+                        return_df: bool = False,
+                        pvalue_mode: str = 'permutation',
+                        kde_backend: str = 'quad',
+                        fp_anno_index: str = None,
+                        progress_callback=None,
+                        timings=None,
+                        side_table_format: str = 'csv'):
+    # Scores the foreground against every background in backgrounds
+    # ({tissue: CSV path or array of cysteines}) separately rather than
+    # pooled, and writes sets x tissues tables of overlaps, p-values,
+    # per-tissue FDR and enrichment scores. In each tissue the foreground is
+    # the annotated foreground cysteines the tissue contains: overlaps are
+    # counted against them and each permutation draws that many cysteines.
+    if pvalue_mode not in ('permutation', 'exact'):
+        raise ValueError(f"Unknown p-value mode: {pvalue_mode}")
+    if side_table_format not in SIDE_TABLE_FORMATS:
+        raise ValueError(f"Unknown side table format: {side_table_format}")
+    if timings is None:
+        timings = StageTimings()
+    fn_root = re.split('/', fp_cys)[-1][:-4]
+    print(f"Processing {fn_root} against {len(backgrounds)} tissue backgrounds...")
+    os.makedirs(output_dir, exist_ok=True)
+
+    ret = {'n_tissues': len(backgrounds), 'tissues': {}}
+    tissues = list(backgrounds)
+
+    with timings.stage('annotation_intersection'):
+        ls_bgcys_anno = read_annotation_background(fp_anno_bgcys)
+        S_cys, ret['n_cys_malformed'] = read_cys_ids(fp_cys)
+        vocab = CysVocabulary()
+        codes_cys = vocab.intern(S_cys)
+        anno_mask = vocab.mask(vocab.intern(ls_bgcys_anno))
+        S_cys_inAnno = pd.Series(annotated_codes(codes_cys, anno_mask))
+
+        df_sets = intersecting_sets(fp_anno, fp_anno_index, vocab, S_cys_inAnno).reset_index(drop=True)
+        # (set, foreground cysteine) pairs once; a tissue counts the pairs
+        # whose cysteine it contains
+        hit_rows, hit_codes = member_hits(df_sets['ls_cys_inSet'], vocab, vocab.mask(S_cys_inAnno))
+
+        # a tissue needs its annotated size, which annotated foreground
+        # cysteines it contains and the per-set overlaps with those
+        ls_n_bg, ls_n_fg = [], []
+        n_cys_x = np.zeros((len(df_sets), len(tissues)), dtype=np.int64)
+        for j, tissue in enumerate(tissues):
+            S_bg, n_malformed = read_cys_ids(backgrounds[tissue])
+            # lookup, not intern: IDs outside the annotation get -1 and the
+            # vocabulary does not grow with every tissue
+            codes_bg = vocab.lookup(S_bg)
+            bg_inAnno = annotated_codes(codes_bg, anno_mask)
+            fg_mask_tissue = vocab.mask(np.intersect1d(bg_inAnno, S_cys_inAnno))
+            n_cys_x[:, j] = np.bincount(hit_rows[fg_mask_tissue[hit_codes]], minlength=len(df_sets))
+            ls_n_bg.append(len(bg_inAnno))
+            ls_n_fg.append(int(fg_mask_tissue.sum()))
+            ret['tissues'][tissue] = {
+                'n_bg_input': len(S_bg),
+                'n_bg_malformed': n_malformed,
+                'n_bg_inAnno': ls_n_bg[-1],
+                'n_cys_inBg': ls_n_fg[-1],
+                'size_permutation': ls_n_fg[-1],
+            }
+            fp = f"{output_dir}/result_{fn_root}_{tissue}_bg_notinAnno"
+            write_side_table(S_bg[~((codes_bg >= 0) & anno_mask[codes_bg])], fp, side_table_format)
+
+    ret['n_cys_input'] = len(S_cys)
+    ret['n_cys_inAnno'] = len(S_cys_inAnno)
+    ret['pvalue_mode'] = pvalue_mode
+    print(f"Number of sets that intersect: {df_sets.shape[0]}")
+
+    pvals, null_median = score_sets_per_background(
+        n_cys_x, ls_n_bg, ls_n_fg, ls_n_fg,
+        n_perm=n_perm,
+        pvalue_mode=pvalue_mode,
+        kde_backend=kde_backend,
+        rng=np.random.default_rng(seed),
+        timings=timings,
+        progress_callback=progress_callback,
+    )
+
+    # as in a pooled run against the tissue, a tissue's FDR is adjusted over
+    # the sets that intersect its foreground, excluded sets included, which
+    # are dropped from the tables afterwards; other sets get no FDR
+    keep = df_sets.index.isin(drop_excluded_sets(df_sets).index)
+    with timings.stage('fdr'):
+        enrichment = (n_cys_x + 1) / (null_median[None, :] + 1)
+        fdr = np.full(pvals.shape, np.nan)
+        for j in range(len(tissues)):
+            ok = ~np.isnan(pvals[:, j]) & (n_cys_x[:, j] > 0)
+            if ok.any():
+                fdr[ok, j] = multipletests(pvals[ok, j], method='fdr_bh')[1]
+            ret['tissues'][tissues[j]]['n_sets_significant'] = int((fdr[keep, j] < 0.05).sum())
+
+    df_info = df_sets[['set_name', 'set_type', 'n_cys_x_set']].copy()
+    df_info.insert(2, 'n_cys_inSet', df_sets['ls_cys_inSet'].apply(len))
+    tables = {}
+    for name, values in (('overlap', n_cys_x), ('p', pvals), ('fdr', fdr), ('enrichment', enrichment)):
+        tables[name] = pd.concat([df_info, pd.DataFrame(values, columns=tissues)], axis=1)[keep]
+        fp = f"{output_dir}/result_{fn_root}_tissues_{name}.csv"
+        tables[name].to_csv(fp, header=True, index=False)
+        print(f"Saved sets x tissues {name} table to {fp}")
+
+    fp = f"{output_dir}/result_{fn_root}_cys_notinAnno"
+    write_side_table(S_cys[~anno_mask[codes_cys]], fp, side_table_format)
+
+    if return_df:
+        ret['df_overlap'] = tables['overlap']
+        ret['df_p'] = tables['p']
+        ret['df_fdr'] = tables['fdr']
+        ret['df_enrichment'] = tables['enrichment']
+    ret['stage_timings'] = timings.as_dict()
     return ret
 
 
+_batch_state = {}
+
+
+def _init_batch_worker(state):
+    _batch_state.clear()
+    _batch_state.update(state)
+
+
+def _run_batch_sample(fp_cys):
+    st = _batch_state
+    with contextlib.redirect_stdout(io.StringIO()):
+        ret = run_csea_analysis(
+            fp_cys,
+            None,
+            None,
+            st['ls_bgcys_anno'],
+            st['output_dir'],
+            fp_anno_index=st['fp_anno_index'],
+            return_df=True,
+            plot_format='none',
+            inputs=add_foreground(st['background'], fp_cys),
+            **st['kwargs'],
+        )
+    return ret['df']
+
+
+def batch_output_path(fp_cys: str, output_dir: str, seed: int) -> str:
+    fn_root = re.split('/', fp_cys)[-1][:-4]
+    return f"{output_dir}/result_{fn_root}_seed{seed}.csv"
+
+
+def batch_params_path(fp_out: str) -> str:
+    return f"{fp_out[:-4]}.params.json"
+
+
+def batch_params_hash(kwargs: dict) -> str:
+    # hash of the analysis options a batch result was computed with; objects
+    # that do not change the result (null library, spill directory) are left out
+    params = {k: v for k, v in kwargs.items() if k not in ('null_library', 'spill_dir')}
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def is_up_to_date(fp_out: str, fp_inputs, params_hash: str = None) -> bool:
+    # the result exists, is newer than every input it was computed from and,
+    # with params_hash, was computed with the same options
+    if not os.path.exists(fp_out):
+        return False
+    if params_hash is not None:
+        fp_params = batch_params_path(fp_out)
+        if not os.path.exists(fp_params):
+            return False
+        with open(fp_params) as f:
+            if json.load(f).get('params_hash') != params_hash:
+                return False
+    t_out = os.path.getmtime(fp_out)
+    return all(os.path.getmtime(fp) <= t_out for fp in fp_inputs if fp is not None)
+
+
+def summarize_batch(dict_df_sample, fdr_threshold: float = 0.05) -> pd.DataFrame:
+    # one row per set, with p_final, fdr and enrichment_score per sample and
+    # the number of samples in which the set passes the FDR threshold
+    df = pd.concat(dict_df_sample, names=['sample', 'row']).reset_index(level='sample')
+    values = ['p_final', 'fdr', 'enrichment_score']
+    df_wide = df.pivot_table(index=['set_name', 'set_type'], columns='sample', values=values)
+    cols = [(value, sample) for sample in dict_df_sample for value in values]
+    df_wide = df_wide.reindex(columns=pd.MultiIndex.from_tuples(cols))
+    n_significant = (df_wide.xs('fdr', axis=1, level=0) < fdr_threshold).sum(axis=1)
+    df_wide.columns = [f"{sample}_{value}" for value, sample in cols]
+    df_wide.insert(0, 'n_samples_significant', n_significant)
+    return df_wide.reset_index().sort_values('n_samples_significant', ascending=False)
+
+
+def run_csea_batch(ls_fp_cys,
+                   fp_bg,
+                   fp_anno,
+                   fp_anno_bgcys,
+                   output_dir,
+                   fp_anno_index: str = None,
+                   n_jobs: int = None,
+                   force: bool = False,
+                   **kwargs):
+    # Runs run_csea_analysis for many foreground lists against one background
+    # and annotation, which are parsed once and shared with a process pool.
+    # Samples whose result_*.csv is newer than all inputs and was computed
+    # with the same options (recorded in result_*.params.json) are skipped
+    # unless force is set. Writes result_batch_summary.csv (sets x samples)
+    # next to the per-sample results. Plots are not drawn in batch mode.
+    seed = kwargs['seeds'][0] if kwargs.get('seeds') else kwargs.get('seed', 34)
+    params_hash = batch_params_hash(kwargs)
+    os.makedirs(output_dir, exist_ok=True)
+    fp_inputs = [fp for fp in (fp_bg, fp_anno, fp_anno_bgcys) if isinstance(fp, str)]
+    if fp_anno_index is not None:
+        fp_inputs += glob(os.path.join(fp_anno_index, '*.npy'))
+
+    dict_df_sample = OrderedDict()
+    ls_todo = []
+    for fp_cys in ls_fp_cys:
+        sample = re.split('/', fp_cys)[-1][:-4]
+        fp_out = batch_output_path(fp_cys, output_dir, seed)
+        if not force and is_up_to_date(fp_out, fp_inputs + [fp_cys], params_hash):
+            dict_df_sample[sample] = pd.read_csv(fp_out)
+        else:
+            dict_df_sample[sample] = None
+            ls_todo.append(fp_cys)
+            # a result without a matching record is never taken as up to date
+            if os.path.exists(batch_params_path(fp_out)):
+                os.remove(batch_params_path(fp_out))
+    print(f"{len(ls_fp_cys) - len(ls_todo)} of {len(ls_fp_cys)} samples are up to date")
+
+    if ls_todo:
+        with tempfile.TemporaryDirectory() as tmp:
+            # the annotation is compiled once into a memory-mapped index that
+            # every worker opens instead of parsing the CSV per sample
+            if fp_anno_index is None:
+                fp_anno_index = build_annotation_index(fp_anno, os.path.join(tmp, 'annotation.idx'))
+            state = {
+                'background': load_background(fp_bg),
+                'ls_bgcys_anno': read_annotation_background(fp_anno_bgcys),
+                'fp_anno_index': fp_anno_index,
+                'output_dir': output_dir,
+                'kwargs': kwargs,
+            }
+            n_jobs = min(n_jobs or os.cpu_count() or 1, len(ls_todo))
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_batch_worker,
+                                     initargs=(state,)) as executor:
+                for fp_cys, df in zip(ls_todo, executor.map(_run_batch_sample, ls_todo)):
+                    sample = re.split('/', fp_cys)[-1][:-4]
+                    dict_df_sample[sample] = df
+                    with open(batch_params_path(batch_output_path(fp_cys, output_dir, seed)), 'w') as f:
+                        json.dump({'params_hash': params_hash}, f)
+                    print(f"Finished {sample}: {int((df['fdr'] < 0.05).sum())} sets at FDR < 0.05")
+
+    df_summary = summarize_batch(dict_df_sample)
+    fp = f"{output_dir}/result_batch_summary.csv"
+    df_summary.to_csv(fp, header=True, index=False)
+    print(f"Saved sets x samples summary for {len(dict_df_sample)} samples to {fp}")
+    return df_summary
+
+
 if __name__ == "__main__":
     import argparse
+    import sys
     
     parser = argparse.ArgumentParser(description='Run CSEA analysis on HR cysteins data')
-    parser.add_argument('--fp_cys', required=True, help='Path to HR cysteins CSV file')
-    parser.add_argument('--fp_bg', required=True, help='Path to background cysteins CSV file')
+    parser.add_argument('--fp_cys', default=None, help='Path to HR cysteins CSV file')
+    parser.add_argument('--fp_cys_glob', default=None,
+                        help='Batch mode: directory or glob of HR cysteins CSV files, processed in parallel '
+                             'against one background and annotation, with a result_batch_summary.csv')
+    parser.add_argument('--n_jobs', type=int, default=None,
+                        help='Batch mode: foreground files processed at once (default: all cores)')
+    parser.add_argument('--force', action='store_true',
+                        help='Batch mode: rerun samples whose results are newer than their inputs')
+    parser.add_argument('--fp_bg', default=None, help='Path to background cysteins CSV file')
+    parser.add_argument('--bg_dir', default=None,
+                        help='Directory of tissue background CSVs (e.g. aggregated_tissue_cysteines/); '
+                             'scores the foreground against each tissue separately instead of --fp_bg')
     parser.add_argument('--fp_anno', required=True, help='Path to annotation CSV file')
     parser.add_argument('--fp_anno_bgcys', required=True, help='Path to unique background cysteins in the annotation CSV file')
     parser.add_argument('--output_dir', required=True, help='Output directory for results')
+    parser.add_argument('--fp_anno_index', default=None,
+                        help='Precompiled annotation index directory (see annotation_index.py); replaces parsing fp_anno')
+    parser.add_argument('--engine', default='vectorized', choices=['loop', 'vectorized'],
+                        help='Permutation engine (loop is the original per-draw set intersection)')
+    parser.add_argument('--null_mode', default='per_set', choices=['per_set', 'shared'],
+                        help='Draw a null per annotation set, or one shared null for the whole run')
+    parser.add_argument('--pvalue_mode', default='permutation', choices=['permutation', 'exact'],
+                        help='Permutation + KDE p-values, or the exact distinct-hit distribution')
+    parser.add_argument('--kde_backend', default='quad', choices=['quad', 'closed_form'],
+                        help='Integrate the KDE tail numerically, or sum the kernel survival functions')
+    parser.add_argument('--compare_quad', action='store_true',
+                        help='Add a p_quad_diff debug column with the difference from the quad p-value')
+    parser.add_argument('--n_perm', type=int, default=500,
+                        help='Permutations per set (upper bound in adaptive mode)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Stop permuting each set once its p-value is settled (Besag-Clifford)')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='Shard sets across this many processes with per-set RNG streams')
+    parser.add_argument('--spill_dir', default=None,
+                        help='Directory for memory-mapping the permutation counts when they exceed 1 GiB')
+    parser.add_argument('--seeds', type=int, nargs='+', default=None,
+                        help='Run one replicate per seed and write a result_*_replicates.csv summary')
+    parser.add_argument('--null_library', default=None,
+                        help='Null library directory used to look up the shared null (see null_library.py)')
+    parser.add_argument('--side_table_format', default='csv', choices=['csv', 'csv.gz', 'parquet'],
+                        help='Format of the large _cys_notinAnno / _bg_notinAnno tables')
+    parser.add_argument('--plot_format', default='png', choices=['png', 'svg', 'json', 'none'],
+                        help='Bar plot as a 300 dpi PNG, SVG, a JSON plot spec, or not at all')
     
     args = parser.parse_args()
+    if (args.fp_cys is None) == (args.fp_cys_glob is None):
+        parser.error('exactly one of --fp_cys and --fp_cys_glob is required')
+    if (args.fp_bg is None) == (args.bg_dir is None):
+        parser.error('exactly one of --fp_bg and --bg_dir is required')
+    if args.fp_cys_glob is not None and args.bg_dir is not None:
+        parser.error('--fp_cys_glob runs against a single --fp_bg')
+
+    if args.bg_dir is not None:
+        run_csea_per_tissue(
+            args.fp_cys,
+            OrderedDict(
+                (os.path.splitext(os.path.basename(fp))[0], fp)
+                for fp in sorted(glob(os.path.join(args.bg_dir, '*.csv')))
+            ),
+            args.fp_anno,
+            args.fp_anno_bgcys,
+            args.output_dir,
+            n_perm=args.n_perm,
+            pvalue_mode=args.pvalue_mode,
+            kde_backend=args.kde_backend,
+            fp_anno_index=args.fp_anno_index,
+        )
+        sys.exit(0)
+
+    null_library = None
+    if args.null_library is not None:
+        from null_library import NullLibrary
+        null_library = NullLibrary(args.null_library)
+
+    if args.fp_cys_glob is not None:
+        pattern = args.fp_cys_glob
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.csv')
+        ls_fp_cys = sorted(glob(pattern))
+        if not ls_fp_cys:
+            parser.error(f'no foreground files match {args.fp_cys_glob}')
+        run_csea_batch(
+            ls_fp_cys,
+            args.fp_bg,
+            args.fp_anno,
+            args.fp_anno_bgcys,
+            args.output_dir,
+            fp_anno_index=args.fp_anno_index,
+            n_jobs=args.n_jobs,
+            force=args.force,
+            n_perm=args.n_perm,
+            engine=args.engine,
+            null_mode=args.null_mode,
+            pvalue_mode=args.pvalue_mode,
+            kde_backend=args.kde_backend,
+            compare_quad=args.compare_quad,
+            adaptive=args.adaptive,
+            seeds=args.seeds,
+            null_library=null_library,
+            side_table_format=args.side_table_format,
+            spill_dir=args.spill_dir,
+        )
+        sys.exit(0)
 
     print('got to main.')
     run_csea_analysis(
@@ -317,5 +1480,19 @@ if __name__ == "__main__":
         args.fp_bg,
         args.fp_anno,
         args.fp_anno_bgcys,
-        args.output_dir
+        args.output_dir,
+        n_perm=args.n_perm,
+        engine=args.engine,
+        null_mode=args.null_mode,
+        pvalue_mode=args.pvalue_mode,
+        kde_backend=args.kde_backend,
+        compare_quad=args.compare_quad,
+        adaptive=args.adaptive,
+        fp_anno_index=args.fp_anno_index,
+        n_workers=args.n_workers,
+        seeds=args.seeds,
+        null_library=null_library,
+        side_table_format=args.side_table_format,
+        plot_format=args.plot_format,
+        spill_dir=args.spill_dir,
     )
\ No newline at end of file
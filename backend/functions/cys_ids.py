@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+
+
+# Input lists write cysteines as <UniProt accession>_C<position>, optionally
+# with an isoform suffix (P12345-2_C45); annotations use a space instead of '_'
+CYS_ID_PATTERN = r'^[A-Za-z0-9][A-Za-z0-9.-]* C\d+$'
+READ_CHUNKSIZE = 500_000
+
+
+def normalize_cys_ids(S) -> pd.Series:
+    return pd.Series(S, dtype=object).astype(str).str.strip().str.replace('_', ' ', regex=False)
+
+
+def read_cys_ids(source, chunksize: int = READ_CHUNKSIZE):
+    # Reads the first column of a headerless CSV path, or takes an array of
+    # IDs, chunk by chunk. Returns the normalized IDs that match
+    # CYS_ID_PATTERN and the number of rows that were dropped as malformed.
+    if isinstance(source, str):
+        chunks = (chunk.iloc[:, 0] for chunk in pd.read_csv(
+            source, header=None, usecols=[0], dtype=str, chunksize=chunksize,
+            skip_blank_lines=False))
+    else:
+        S = pd.Series(source, dtype=object)
+        chunks = (S.iloc[i:i + chunksize] for i in range(0, len(S), chunksize))
+
+    parts = []
+    n_malformed = 0
+    for S_chunk in chunks:
+        is_na = S_chunk.isna().to_numpy()
+        S_chunk = normalize_cys_ids(S_chunk[~is_na])
+        is_valid = S_chunk.str.match(CYS_ID_PATTERN).to_numpy()
+        n_malformed += int(is_na.sum() + (~is_valid).sum())
+        parts.append(S_chunk[is_valid])
+
+    if not parts:
+        return pd.Series([], dtype=object), n_malformed
+    return pd.concat(parts, ignore_index=True), n_malformed
+
+
+class CysVocabulary:
+    # Interns cysteine IDs into int32 codes, assigned in first-seen order, so
+    # that membership tests and set overlaps after parsing work on integers.
+
+    def __init__(self):
+        self.ids = pd.Index([], dtype=object)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, S) -> np.ndarray:
+        uniques = pd.unique(pd.Series(S, dtype=object))
+        new = uniques[self.ids.get_indexer(uniques) < 0]
+        if len(new) > 0:
+            self.ids = self.ids.append(pd.Index(new, dtype=object))
+        return self.lookup(S)
+
+    def lookup(self, S) -> np.ndarray:
+        # -1 for IDs that were never interned
+        return self.ids.get_indexer(pd.Series(S, dtype=object)).astype(np.int32)
+
+    def decode(self, codes) -> pd.Series:
+        return pd.Series(self.ids[np.asarray(codes)], dtype=object)
+
+    def mask(self, codes) -> np.ndarray:
+        # boolean indicator over the whole vocabulary
+        indicator = np.zeros(len(self), dtype=bool)
+        codes = np.asarray(codes)
+        indicator[codes[codes >= 0]] = True
+        return indicator
+
+
+def annotated_codes(codes, anno_mask) -> np.ndarray:
+    # unique codes that are in the annotation, in code order
+    codes = np.asarray(codes)
+    codes = codes[codes >= 0]
+    return np.unique(codes[anno_mask[codes]])
+
+
+def member_hits(S_members, vocab: CysVocabulary, fg_mask):
+    # (set row, code) pairs of the members that are in fg_mask, each pair once
+    if len(S_members) == 0 or S_members.apply(len).sum() == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    lengths = S_members.apply(len).to_numpy()
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    codes = vocab.lookup(np.concatenate(S_members.to_list()))
+    is_hit = codes >= 0
+    is_hit[is_hit] = fg_mask[codes[is_hit]]
+    hits = pd.DataFrame({'row': rows[is_hit], 'code': codes[is_hit]}).drop_duplicates()
+    return hits['row'].to_numpy(), hits['code'].to_numpy()
+
+
+def count_member_overlaps(S_members, vocab: CysVocabulary, fg_mask) -> np.ndarray:
+    # S_members: one list of member IDs per set. A set lists each cysteine once
+    # as far as the overlap count is concerned.
+    rows, _ = member_hits(S_members, vocab, fg_mask)
+    return np.bincount(rows, minlength=len(S_members))
@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def _current_rss_mb():
+    # resident set size of this process right now; /proc is Linux only, so
+    # elsewhere memory is reported as 0
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        return 0.0
+
+
+class _RssSampler:
+    # One daemon thread polling the RSS while any stage is open. Every open
+    # stage keeps the highest RSS seen since it began, so a stage's peak is
+    # measured over that stage only rather than over the life of the process.
+
+    def __init__(self, interval: float = 0.02):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.wake = threading.Event()
+        self.thread = None
+
+    def open(self):
+        rss = _current_rss_mb()
+        token = object()
+        with self.lock:
+            self.peaks[token] = rss
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        self.wake.set()
+        return token, rss
+
+    def close(self, token) -> float:
+        rss = _current_rss_mb()
+        with self.lock:
+            return max(self.peaks.pop(token), rss)
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            rss = _current_rss_mb()
+            with self.lock:
+                if not self.peaks:
+                    self.wake.clear()
+                    continue
+                for token in self.peaks:
+                    self.peaks[token] = max(self.peaks[token], rss)
+            time.sleep(self.interval)
+
+
+_rss_sampler = _RssSampler()
+
+
+class StageTimings:
+    # Wall time, CPU time and memory per pipeline stage. Entering the same
+    # stage again (per set, per replicate) accumulates wall and CPU time and
+    # counts the calls. cpu_s is the CPU time of the thread running the stage,
+    # so jobs sharing the process do not count each other's work.
+    # peak_rss_delta_mb is the largest rise of this process's RSS above its
+    # value at the start of a call, sampled while the stage runs; memory of
+    # pool worker processes is not included.
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _entry(self, name: str):
+        return self.stages.setdefault(
+            name, {'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_delta_mb': 0.0, 'calls': 0})
+
+    def _record(self, name: str, wall_s: float, cpu_s: float, rss_delta_mb: float):
+        with self.lock:
+            entry = self._entry(name)
+            entry['wall_s'] += wall_s
+            entry['cpu_s'] += cpu_s
+            entry['peak_rss_delta_mb'] = max(entry['peak_rss_delta_mb'], rss_delta_mb)
+            entry['calls'] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        wall0 = time.perf_counter()
+        cpu0 = time.thread_time()
+        token, rss0 = _rss_sampler.open()
+        try:
+            yield
+        finally:
+            peak = _rss_sampler.close(token)
+            self._record(name, time.perf_counter() - wall0, time.thread_time() - cpu0, peak - rss0)
+
+    @contextmanager
+    def parallel_stages(self):
+        # For work that a process pool runs for several stages at once: the
+        # body calls the yielded function with {stage: (wall_s, cpu_s)} as
+        # measured by each worker. The elapsed wall time is split across the
+        # stages in proportion to the workers' wall time in each, and their CPU
+        # time is recorded as is.
+        worker_times = OrderedDict()
+
+        def report(times: dict):
+            for name, (wall_s, cpu_s) in times.items():
+                total = worker_times.setdefault(name, [0.0, 0.0])
+                total[0] += wall_s
+                total[1] += cpu_s
+
+        wall0 = time.perf_counter()
+        token, rss0 = _rss_sampler.open()
+        try:
+            yield report
+        finally:
+            peak = _rss_sampler.close(token)
+            wall = time.perf_counter() - wall0
+            worker_wall = sum(wall_s for wall_s, _ in worker_times.values())
+            for name, (wall_s, cpu_s) in worker_times.items():
+                share = wall_s / worker_wall if worker_wall > 0 else 1.0 / len(worker_times)
+                self._record(name, wall * share, cpu_s, peak - rss0)
+
+    def as_dict(self) -> dict:
+        return {
+            name: {
+                'wall_s': round(entry['wall_s'], 4),
+                'cpu_s': round(entry['cpu_s'], 4),
+                'peak_rss_delta_mb': round(entry['peak_rss_delta_mb'], 1),
+                'calls': entry['calls'],
+            }
+            for name, entry in self.stages.items()
+        }
@@ -0,0 +1,147 @@
+import contextlib
+import io
+import queue
+import sys
+import threading
+import traceback
+
+
+class ProgressTracker:
+    # Maps per-stage completion fractions onto one 0-100 job percentage.
+    # stages is a list of (name, weight); report is called with the new
+    # integer percentage only when it changes.
+
+    def __init__(self, report, stages):
+        self.report = report
+        self.offsets = {}
+        self.weights = {}
+        total = float(sum(weight for _, weight in stages))
+        offset = 0.0
+        for name, weight in stages:
+            self.offsets[name] = offset
+            self.weights[name] = weight / total
+            offset += weight / total
+        self.percent = None
+        self.lock = threading.Lock()
+
+    def update(self, stage: str, fraction: float):
+        fraction = min(max(float(fraction), 0.0), 1.0)
+        percent = int(100 * (self.offsets[stage] + self.weights[stage] * fraction))
+        with self.lock:
+            if self.percent is not None and percent <= self.percent:
+                return
+            self.percent = percent
+        self.report(percent)
+
+    def stage_callback(self, stage: str):
+        return lambda fraction: self.update(stage, fraction)
+
+
+class ThreadLocalStdout:
+    # Stand-in for sys.stdout that sends writes from a thread inside
+    # capture_output() to that thread's buffer and everything else to the
+    # stream it replaced, so concurrent jobs each keep their own logs.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _target(self):
+        buffer = getattr(self.local, "buffer", None)
+        return self.stream if buffer is None else buffer
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_stdout_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def capture_output(buffer=None):
+    # collects what the calling thread prints into buffer (a new StringIO
+    # by default), which is also yielded
+    with _stdout_lock:
+        if not isinstance(sys.stdout, ThreadLocalStdout):
+            sys.stdout = ThreadLocalStdout(sys.stdout)
+        proxy = sys.stdout
+    if buffer is None:
+        buffer = io.StringIO()
+    previous = getattr(proxy.local, "buffer", None)
+    proxy.local.buffer = buffer
+    try:
+        yield buffer
+    finally:
+        proxy.local.buffer = previous
+
+
+class InProcessJobQueue:
+    # Queue backend for local runs and tests: jobs stay in this process and are
+    # drained by a JobWorker.
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+
+    def enqueue(self, payload: dict):
+        self.jobs.put(payload)
+
+    def get(self, timeout: float = None):
+        return self.jobs.get(timeout=timeout)
+
+    def task_done(self):
+        self.jobs.task_done()
+
+    def join(self):
+        self.jobs.join()
+
+
+class JobWorker:
+    # Drains a queue with at most max_concurrency jobs running at once. handler
+    # is called with each payload and is responsible for recording failures on
+    # the job itself; exceptions are logged and do not stop the worker.
+
+    def __init__(self, job_queue, handler, max_concurrency: int = 1):
+        self.job_queue = job_queue
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                payload = self.job_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self.handler(payload)
+            except Exception:
+                print(f"Job {payload.get('jobId')} failed in worker:\n{traceback.format_exc()}")
+            finally:
+                self.job_queue.task_done()
+
+    def start(self):
+        if self.threads:
+            return self
+        self.stopping.clear()
+        for i in range(self.max_concurrency):
+            thread = threading.Thread(target=self._run, name=f"csea-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def drain(self):
+        # block until every queued job has been handled
+        self.job_queue.join()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
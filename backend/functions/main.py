@@ -1,54 +1,341 @@
 import os
-import sys
 import tempfile
 import traceback
 import io
+import re
 import json
+import gzip
+import hashlib
+import threading
+import time
+import uuid
 
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-from firebase_admin import initialize_app, firestore, storage, credentials
-from firebase_functions import https_fn, options
+from firebase_admin import initialize_app, firestore, storage, credentials, functions
+from firebase_functions import https_fn, tasks_fn, scheduler_fn, options
 from google.cloud import storage as cloud_storage
-import pandas as pd
 
-from csea500b import run_csea_analysis
+# pandas, the analysis modules (scipy, statsmodels) and matplotlib are imported
+# inside the functions that use them, so that a cold start of a light endpoint
+# such as preview_csv does not pay for them
+from job_queue import ProgressTracker, InProcessJobQueue, JobWorker, capture_output
+from instrumentation import StageTimings
 
 initialize_app()
 
-def merge_background_files(bucket, background_paths, temp_dir):
-    all_backgrounds = []
-    for bg_path in background_paths:
-        if bg_path.startswith("gs://"):
-            bg_path = "/".join(bg_path.split("/")[3:])
-        local_path = os.path.join(temp_dir, f"bg_{os.path.basename(bg_path)}")
-        download_blob(bucket, bg_path, local_path)
-        df = pd.read_csv(local_path)
-        all_backgrounds.append(df)
-
-    merged_df = pd.concat(all_backgrounds, ignore_index=True)
-    merged_path = os.path.join(temp_dir, "merged_background.csv")
-    merged_df.to_csv(merged_path, index=False)
-    return merged_path
+BUCKET_NAME = os.environ.get("CSEA_BUCKET", "zaro-lab.firebasestorage.app")
+QUEUE_BACKEND = os.environ.get("CSEA_QUEUE", "cloud_tasks")
+WORKER_CONCURRENCY = int(os.environ.get("CSEA_WORKER_CONCURRENCY", 2))
+# each of the WORKER_CONCURRENCY jobs on an instance gets an equal share of
+# the CPUs it may run on (os.cpu_count() is the host's count, not the quota)
+ANALYSIS_WORKERS = max(1, int(os.environ.get("CSEA_CPUS", len(os.sched_getaffinity(0)))) // WORKER_CONCURRENCY)
+JOB_TIMEOUT_SEC = 3600
+CACHE_DIR = os.environ.get("CSEA_CACHE_DIR", "/tmp/csea_cache")
+CACHE_MAX_BYTES = int(os.environ.get("CSEA_CACHE_MAX_BYTES", 4 * 1024 ** 3))
+# permutation count matrices over 1 GiB are memory-mapped here instead of held
+# in RAM; /tmp is memory-backed on Cloud Functions, so this is off unless a
+# disk-backed directory is configured
+SPILL_DIR = os.environ.get("CSEA_SPILL_DIR")
+RESULT_CACHE_COLLECTION = "resultCache"
+RESULT_CACHE_TTL_DAYS = int(os.environ.get("CSEA_RESULT_CACHE_TTL_DAYS", 30))
+# part of every result cache key; bump it whenever a change to the analysis
+# changes its results, so results cached by older code are not served
+ALGORITHM_VERSION = 2
+
+# On-disk LRU cache of reference and background blobs, shared by requests on a
+# warm instance. Entries are invalidated when the blob generation changes and
+# the least recently used files are evicted once the cache exceeds max_bytes.
+# Entries fetched with a pins list are reference counted and never evicted
+# until the caller hands the list back to release().
+class BlobCache:
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pins = Counter()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def release(self, pins: list):
+        with self.lock:
+            for key in pins:
+                self.pins[key] -= 1
+                if self.pins[key] <= 0:
+                    del self.pins[key]
+            pins.clear()
+            self._evict(keep=None)
+
+    def fetch(self, bucket: cloud_storage.Bucket, blob_path: str, stats: dict = None, pins: list = None):
+        # returns the local path of the blob, or None when it does not exist;
+        # with pins, the entry stays on disk until release(pins)
+        blob = bucket.get_blob(blob_path)
+        if blob is None:
+            return None
+        if stats is None:
+            stats = {}
+        key = f"{bucket.name}/{blob_path}"
+        local_path = os.path.join(self.cache_dir, key)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == blob.generation and os.path.exists(local_path):
+                self.entries.move_to_end(key)
+                if pins is not None:
+                    self.pins[key] += 1
+                    pins.append(key)
+                stats["cache_hits"] = stats.get("cache_hits", 0) + 1
+                stats["cache_bytes_saved"] = stats.get("cache_bytes_saved", 0) + entry[1]
+                return local_path
+
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        part_path = f"{local_path}.{uuid.uuid4().hex}.part"
+        blob.download_to_filename(part_path)
+        os.replace(part_path, local_path)
+        size = os.path.getsize(local_path)
+
+        with self.lock:
+            stale = self.entries.pop(key, None)
+            if stale is not None:
+                self.total_bytes -= stale[1]
+            self.entries[key] = (blob.generation, size)
+            self.total_bytes += size
+            if pins is not None:
+                self.pins[key] += 1
+                pins.append(key)
+            self._evict(keep=key)
+            stats["cache_misses"] = stats.get("cache_misses", 0) + 1
+        return local_path
+
+    def _evict(self, keep: str):
+        # least recently used first, skipping entries that are pinned
+        for key in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep or self.pins[key] > 0:
+                continue
+            _, size = self.entries.pop(key)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, key))
+            except FileNotFoundError:
+                pass
+
+reference_cache = BlobCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+def fetch_background(bucket, bg_path, cache_stats: dict = None, cache_pins: list = None):
+    t0 = time.perf_counter()
+    if bg_path.startswith("gs://"):
+        bg_path = "/".join(bg_path.split("/")[3:])
+    local_path = reference_cache.fetch(bucket, bg_path, cache_stats, cache_pins)
+    if local_path is None:
+        raise FileNotFoundError(f"Background file not found: {bg_path}")
+    t1 = time.perf_counter()
+    import pandas as pd
+    # tissue background files start with a header row
+    S_bg = pd.read_csv(local_path).iloc[:, 0]
+    t2 = time.perf_counter()
+    log = (f"Background {os.path.basename(bg_path)}: {len(S_bg)} cysteines, "
+           f"fetch {t1 - t0:.2f}s, parse {t2 - t1:.2f}s")
+    return S_bg, log
+
+def fetch_background_files(bucket, background_paths, cache_stats: dict = None, max_workers: int = 8,
+                           cache_pins: list = None):
+    # fetch and parse the selected tissues concurrently; returns
+    # ({tissue: cysteines}, logs) with tissues named after their files
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(background_paths)))) as executor:
+        results = list(executor.map(
+            lambda bg_path: fetch_background(bucket, bg_path, cache_stats, cache_pins), background_paths))
+    backgrounds = OrderedDict(
+        (os.path.splitext(os.path.basename(bg_path))[0], S_bg.to_numpy())
+        for bg_path, (S_bg, _) in zip(background_paths, results)
+    )
+    return backgrounds, [log for _, log in results]
+
+def merge_background_files(bucket, background_paths, cache_stats: dict = None, max_workers: int = 8,
+                           cache_pins: list = None):
+    # merge the selected tissues into a single de-duplicated array that is
+    # handed straight to the analysis
+    import pandas as pd
+    t0 = time.perf_counter()
+    backgrounds, log_lines = fetch_background_files(bucket, background_paths, cache_stats, max_workers, cache_pins)
+    all_backgrounds = [pd.Series(S_bg) for S_bg in backgrounds.values()]
+
+    merged = pd.concat(all_backgrounds, ignore_index=True).drop_duplicates().to_numpy()
+    log_lines.append(f"Merged {len(background_paths)} backgrounds into {len(merged)} unique cysteines "
+                     f"in {time.perf_counter() - t0:.2f}s")
+    return merged, log_lines
 
 def download_blob(bucket: cloud_storage.Bucket, source_blob_path: str, destination_file_path: str):
     blob = bucket.blob(source_blob_path)
     blob.download_to_filename(destination_file_path)
     return destination_file_path
 
+def download_reference(bucket: cloud_storage.Bucket, reference_path: str, cache_stats: dict = None,
+                       cache_pins: list = None):
+    local_path = reference_cache.fetch(bucket, reference_path, cache_stats, cache_pins)
+    if local_path is None:
+        raise FileNotFoundError(f"Reference file not found: {reference_path}")
+    return local_path
+
+def download_annotation_index(bucket: cloud_storage.Bucket, anno_csv: str, cache_stats: dict = None,
+                              cache_pins: list = None):
+    # the compiled index lives next to the CSV as reference/<stem>.idx/*.npy;
+    # returns None when it has not been built so the caller can use the CSV
+    from annotation_index import INDEX_ARRAYS, annotation_index_path
+    remote_index = f"reference/{annotation_index_path(anno_csv)}"
+    local_index = None
+    for name in INDEX_ARRAYS:
+        local_path = reference_cache.fetch(bucket, f"{remote_index}/{name}.npy", cache_stats, cache_pins)
+        if local_path is None:
+            return None
+        local_index = os.path.dirname(local_path)
+    return local_index
+
+# .csv.gz files are stored as plain gzip objects without Content-Encoding,
+# so GCS does not decompress them on download and users get the .gz they see
+OUTPUT_CONTENT_TYPES = {
+    ".csv": "text/csv",
+    ".csv.gz": "application/gzip",
+    ".parquet": "application/vnd.apache.parquet",
+    ".png": "image/png",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+}
+
+def output_content_type(filename: str):
+    for suffix, content in OUTPUT_CONTENT_TYPES.items():
+        if filename.endswith(suffix):
+            return content
+    return None
+
+def count_csv_rows(local_file_path: str, chunk_size: int = 1 << 20) -> int:
+    # data rows, i.e. lines after the header, without parsing the file
+    n_lines = 0
+    last = b"\n"
+    opener = gzip.open if local_file_path.endswith(".gz") else open
+    with opener(local_file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            n_lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    if last != b"\n":
+        n_lines += 1
+    return max(n_lines - 1, 0)
+
 def upload_results(bucket: cloud_storage.Bucket, local_file_path: str, destination_blob_path: str) -> str:
     blob = bucket.blob(destination_blob_path)
-    blob.upload_from_filename(local_file_path)
+    content_type = output_content_type(local_file_path)
+    if local_file_path.endswith(".csv") or local_file_path.endswith(".csv.gz"):
+        # preview_csv reads the total row count from here instead of the file
+        blob.metadata = {"rowCount": str(count_csv_rows(local_file_path))}
+    blob.upload_from_filename(local_file_path, content_type=content_type)
     blob.make_public()
     return f"https://storage.googleapis.com/{bucket.name}/{destination_blob_path}"
 
+PREVIEW_CHUNK_BYTES = 256 * 1024
+PREVIEW_MAX_LIMIT = 500
+PREVIEW_CACHE_SIZE = 64
+_preview_cache = OrderedDict()
+_preview_cache_lock = threading.Lock()
+
+def read_csv_rows_ranged(blob: cloud_storage.Blob, offset: int, limit: int):
+    # Fetch the blob in growing byte ranges until the header plus
+    # offset + limit complete lines are available (or the file ends), then
+    # parse only that prefix. Returns (df, reached_end, n_data_lines_seen).
+    import pandas as pd
+    n_needed = offset + limit + 1
+    data = b""
+    end = 0
+    reached_end = False
+    chunk = PREVIEW_CHUNK_BYTES
+    while not reached_end and data.count(b"\n") < n_needed:
+        new_end = end + chunk if blob.size is None else min(end + chunk, blob.size)
+        if new_end <= end:
+            reached_end = True
+            break
+        data += blob.download_as_bytes(start=end, end=new_end - 1)
+        reached_end = blob.size is not None and new_end >= blob.size
+        end = new_end
+        chunk *= 2
+
+    if not reached_end:
+        data = data[:data.rfind(b"\n") + 1]
+    n_lines = data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+    df = pd.read_csv(io.BytesIO(data), skiprows=range(1, offset + 1), nrows=limit)
+    return df, reached_end, max(n_lines - 1, 0)
+
+def file_md5(local_file_path: str, chunk_size: int = 1 << 20) -> str:
+    md5 = hashlib.md5()
+    with open(local_file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def upload_output_files(bucket: cloud_storage.Bucket, output_dir: str, job_id: str,
+                        progress_callback=None, max_workers: int = 8) -> list:
+    # upload every output concurrently; the manifest lists each file's URL,
+    # size in bytes and MD5 in the order the files were listed
+    # filenames are relative to output_dir, so per-annotation subdirectories
+    # of an "all" job keep their prefix in the bucket
+    filenames = sorted(
+        os.path.relpath(os.path.join(root, filename), output_dir)
+        for root, _, files in os.walk(output_dir)
+        for filename in files
+        if output_content_type(filename) is not None
+    )
+    if not filenames:
+        return []
+    n_done = [0]
+    done_lock = threading.Lock()
+
+    def upload_one(filename):
+        local_path = os.path.join(output_dir, filename)
+        entry = {
+            "filename": filename,
+            "url": upload_results(bucket, local_path, f"results/{job_id}/{filename}"),
+            "size": os.path.getsize(local_path),
+            "md5": file_md5(local_path),
+        }
+        if progress_callback is not None:
+            with done_lock:
+                n_done[0] += 1
+                progress_callback(n_done[0] / len(filenames))
+        return entry
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(filenames))) as executor:
+        return list(executor.map(upload_one, filenames))
+
+@lru_cache(maxsize=1)
+def get_db():
+    # one Firestore client per instance, created on first use and shared by
+    # every request and worker thread
+    return firestore.client()
+
+@lru_cache(maxsize=1)
+def get_storage_client() -> cloud_storage.Client:
+    # honours STORAGE_EMULATOR_HOST, like firestore.client() does for
+    # FIRESTORE_EMULATOR_HOST
+    return cloud_storage.Client()
+
+def get_bucket() -> cloud_storage.Bucket:
+    return get_storage_client().bucket(BUCKET_NAME)
+
 def update_job_status(
     job_ref: firestore.DocumentReference,
     status: str,
     step: str,
     error: str = None,
     output_files: list = None,
-    logs: list = None
+    logs: list = None,
+    progress: int = None,
+    stats: dict = None
 ):
     update_data = {
         "status": status,
@@ -61,16 +348,373 @@ def update_job_status(
         update_data["outputFiles"] = output_files
     if logs is not None and len(logs) > 0:
         update_data["logs"] = firestore.ArrayUnion(logs)
+    if progress is not None:
+        update_data["progress"] = progress
+    if stats is not None:
+        update_data["stats"] = stats
 
     job_ref.update(update_data)
 
+ANNOTATION_FILES = OrderedDict([
+    ("molecular", ("df_annotation_sub_molecular_features.csv", "bgcys_anno_molecular_features.csv")),
+    ("experimental", ("df_annotation_sub_experimental_data.csv", "bgcys_anno_experimental_data.csv")),
+    ("structural", ("df_annotation_sub_structural.csv", "bgcys_anno_structural.csv")),
+])
+
+def resolve_annotation_files(annotation_sel: str):
+    return ANNOTATION_FILES.get(annotation_sel, ANNOTATION_FILES["molecular"])
+
+def resolve_annotation_families(annotation_sel: str) -> list:
+    # "all" runs every annotation family in one job
+    if annotation_sel == "all":
+        return list(ANNOTATION_FILES)
+    return [annotation_sel if annotation_sel in ANNOTATION_FILES else "molecular"]
+
+def download_annotation_files(bucket: cloud_storage.Bucket, annotation_sel: str, cache_stats: dict = None,
+                              cache_pins: list = None) -> dict:
+    # {family: {'fp_anno', 'fp_anno_bgcys', 'fp_anno_index'}}; fp_anno is only
+    # downloaded when there is no compiled index for the family
+    annotations = OrderedDict()
+    for family in resolve_annotation_families(annotation_sel):
+        anno_csv, bgcys_csv = ANNOTATION_FILES[family]
+        files = {"fp_anno": None}
+        files["fp_anno_index"] = download_annotation_index(bucket, anno_csv, cache_stats, cache_pins)
+        if files["fp_anno_index"] is None:
+            files["fp_anno"] = download_reference(bucket, f"reference/{anno_csv}", cache_stats, cache_pins)
+        files["fp_anno_bgcys"] = download_reference(bucket, f"reference/{bgcys_csv}", cache_stats, cache_pins)
+        annotations[family] = files
+    return annotations
+
+def analysis_params(request_json: dict) -> dict:
+    # every request field that changes the analysis output, with defaults applied
+    adaptive = bool(request_json.get("adaptivePermutation", False))
+    plot_format = request_json.get("plotFormat", "png")
+    # "deferred" only writes the JSON plot spec; render_plot draws the image
+    # the first time it is asked for
+    if plot_format == "deferred":
+        plot_format = "json"
+    return {
+        "annotation_sel": request_json.get("annotationSelection", "molecular"),
+        # "pooled" merges the selected tissues into one background,
+        # "per_tissue" scores the foreground against each of them
+        "background_mode": request_json.get("backgroundMode", "pooled"),
+        "adaptive": adaptive,
+        "n_perm": int(request_json.get("maxPermutations", 5000 if adaptive else 500)),
+        "seed": int(request_json.get("seed", 34)),
+        # the shared null is looked up in the instance's null library, which
+        # per_set never reads; adaptive permutation needs per_set
+        "null_mode": request_json.get("nullMode", "per_set" if adaptive else "shared"),
+        "side_table_format": request_json.get("sideTableFormat", "csv"),
+        "plot_format": plot_format,
+    }
+
+def blob_generation(bucket: cloud_storage.Bucket, blob_path: str):
+    if blob_path.startswith("gs://"):
+        blob_path = "/".join(blob_path.split("/")[3:])
+    blob = bucket.get_blob(blob_path)
+    return None if blob is None else blob.generation
+
+def result_cache_key(bucket: cloud_storage.Bucket, foreground_bytes: bytes,
+                     background_selections: list, params: dict) -> str:
+    # Content hash of everything a result depends on: the foreground bytes,
+    # the selected tissues, the analysis parameters, the generations of the
+    # reference files and ALGORITHM_VERSION, so that updating a reference or
+    # the analysis invalidates its results.
+    background_selections = sorted(background_selections)
+    reference_paths = list(background_selections)
+    for family in resolve_annotation_families(params["annotation_sel"]):
+        reference_paths += [f"reference/{csv}" for csv in ANNOTATION_FILES[family]]
+    reference_versions = {path: blob_generation(bucket, path) for path in reference_paths}
+    h = hashlib.sha256(foreground_bytes)
+    h.update(json.dumps({
+        "algorithmVersion": ALGORITHM_VERSION,
+        "backgroundSelections": background_selections,
+        "referenceVersions": reference_versions,
+        "params": params,
+    }, sort_keys=True).encode())
+    return h.hexdigest()
+
+def get_cached_result(db, bucket: cloud_storage.Bucket, result_key: str):
+    # Finished result for the key, or None. Entries older than
+    # RESULT_CACHE_TTL_DAYS, or whose output blobs are gone, are dropped.
+    doc_ref = db.collection(RESULT_CACHE_COLLECTION).document(result_key)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return None
+    cached = doc.to_dict()
+    created = cached.get("createdAt")
+    expired = created is None or (
+        datetime.now(created.tzinfo) - created > timedelta(days=RESULT_CACHE_TTL_DAYS))
+    missing = any(
+        bucket.get_blob(f"results/{cached['jobId']}/{entry['filename']}") is None
+        for entry in cached.get("outputFiles", [])
+    )
+    if expired or missing:
+        doc_ref.delete()
+        return None
+    doc_ref.update({"lastUsed": firestore.SERVER_TIMESTAMP, "hits": firestore.Increment(1)})
+    return cached
+
+def store_cached_result(db, result_key: str, job_id: str, output_urls: list, stats: dict):
+    db.collection(RESULT_CACHE_COLLECTION).document(result_key).set({
+        "jobId": job_id,
+        "outputFiles": output_urls,
+        "stats": stats,
+        "createdAt": firestore.SERVER_TIMESTAMP,
+        "lastUsed": firestore.SERVER_TIMESTAMP,
+        "hits": 0,
+    })
+
+def evict_result_cache(db, max_age_days: int = RESULT_CACHE_TTL_DAYS) -> int:
+    # deletes cache entries created more than max_age_days ago; the result
+    # files themselves stay with the job that produced them
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    n_deleted = 0
+    for doc in db.collection(RESULT_CACHE_COLLECTION).where("createdAt", "<", cutoff).stream():
+        doc.reference.delete()
+        n_deleted += 1
+    return n_deleted
+
+def expire_stale_jobs(db) -> int:
+    # jobs still INITIALIZING or RUNNING past their deadline lost their worker
+    # to the function timeout or a crash; they are marked ERROR
+    n_expired = 0
+    now = datetime.utcnow()
+    for doc in db.collection("analysisJobs").where("deadline", "<", now).stream():
+        if doc.to_dict().get("status") not in ("INITIALIZING", "RUNNING"):
+            continue
+        update_job_status(
+            doc.reference,
+            "ERROR",
+            "Analysis failed",
+            error=f"Analysis did not finish within {JOB_TIMEOUT_SEC} seconds",
+        )
+        n_expired += 1
+    return n_expired
+
+def complete_from_cache(job_ref: firestore.DocumentReference, result_key: str, cached: dict):
+    # the new job points at the outputs of the job that produced the result
+    stats = dict(cached.get("stats", {}), result_cache_hit=True)
+    update_job_status(
+        job_ref,
+        "COMPLETED",
+        "Analysis complete (cached result)",
+        output_files=cached["outputFiles"],
+        progress=100,
+        stats=stats,
+    )
+    job_ref.update({"cachedFromJobId": cached["jobId"], "resultKey": result_key})
+    return stats, cached["outputFiles"]
+
+def result_job_id(db, job_id: str) -> str:
+    # a job answered from the result cache reads its source job's outputs
+    job_doc = db.collection("analysisJobs").document(job_id).get()
+    if job_doc.exists:
+        return job_doc.to_dict().get("cachedFromJobId") or job_id
+    return job_id
+
+def process_job(request_json: dict, db, bucket: cloud_storage.Bucket):
+    # Runs one analysis job end to end and records status, progress, logs and
+    # stats on analysisJobs/<jobId>. Shared by the synchronous endpoint and the
+    # queue worker. Returns (ret, output_urls); failures are recorded on the job
+    # and re-raised. Unless forceRerun is set, a finished result for the same
+    # inputs is reused instead of running the analysis again. A queued job
+    # carries the resultKey run_analysis computed when it was submitted.
+    from csea500b import run_csea_analysis, run_csea_all_annotations, run_csea_per_tissue
+    from null_library import NullLibrary
+
+    job_id = request_json["jobId"]
+    foreground_file_path = request_json["foregroundFilePath"]
+    background_selections = request_json["backgroundSelections"]
+    force_rerun = bool(request_json.get("forceRerun", False))
+    params = analysis_params(request_json)
+    annotation_sel = params["annotation_sel"]
+    adaptive = params["adaptive"]
+    n_perm = params["n_perm"]
+    null_mode = params["null_mode"]
+    side_table_format = params["side_table_format"]
+    plot_format = params["plot_format"]
+    background_mode = params["background_mode"]
+
+    job_ref = db.collection("analysisJobs").document(job_id)
+    progress = ProgressTracker(
+        lambda percent: job_ref.update({"progress": percent}),
+        [("download", 15), ("analysis", 75), ("upload", 10)],
+    )
+
+    timings = StageTimings()
+
+    update_job_status(job_ref, "INITIALIZING", "Starting analysis")
+    # a worker killed at its timeout never reaches the except below;
+    # expire_stale_jobs marks the job as failed once this has passed
+    job_ref.update({"deadline": datetime.utcnow() + timedelta(seconds=JOB_TIMEOUT_SEC)})
+
+    # cached references this job reads stay on disk until it finishes
+    cache_pins = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            if background_mode not in ("pooled", "per_tissue"):
+                raise ValueError(f"Unknown background mode: {background_mode}")
+            if background_mode == "per_tissue" and annotation_sel == "all":
+                raise ValueError("backgroundMode per_tissue runs one annotation family at a time")
+            # per_tissue draws one shared null per tissue and writes tables only
+            if background_mode == "per_tissue" and (adaptive or null_mode != "shared"):
+                raise ValueError("backgroundMode per_tissue needs nullMode shared without adaptivePermutation")
+            if background_mode == "per_tissue" and "plotFormat" in request_json and plot_format != "none":
+                raise ValueError("backgroundMode per_tissue does not draw a plot; plotFormat must be none")
+
+            update_job_status(job_ref, "RUNNING", "Downloading input files")
+
+            local_foreground_path = os.path.join(temp_dir, f"{job_id}_foreground.csv")
+            result_key = request_json.get("resultKey")
+            with timings.stage("download"):
+                download_blob(bucket, foreground_file_path, local_foreground_path)
+                if result_key is None:
+                    with open(local_foreground_path, "rb") as f:
+                        result_key = result_cache_key(bucket, f.read(), background_selections, params)
+            if not force_rerun:
+                cached = get_cached_result(db, bucket, result_key)
+                if cached is not None:
+                    print(f"Job {job_id}: reusing the result of job {cached['jobId']}")
+                    return complete_from_cache(job_ref, result_key, cached)
+            progress.update("download", 0.2)
+
+            cache_stats = {"cache_hits": 0, "cache_misses": 0, "cache_bytes_saved": 0}
+            with timings.stage("background_merge"):
+                if background_mode == "per_tissue":
+                    background_cys, merge_logs = fetch_background_files(
+                        bucket, background_selections, cache_stats, cache_pins=cache_pins)
+                else:
+                    background_cys, merge_logs = merge_background_files(
+                        bucket, background_selections, cache_stats, cache_pins=cache_pins)
+            update_job_status(job_ref, "RUNNING", "Merged background files", logs=merge_logs)
+            progress.update("download", 0.7)
+
+            with timings.stage("download"):
+                annotations = download_annotation_files(bucket, annotation_sel, cache_stats, cache_pins)
+            progress.update("download", 1.0)
+
+            output_dir = os.path.join(temp_dir, f"results_{job_id}")
+            os.makedirs(output_dir, exist_ok=True)
+
+            update_job_status(job_ref, "RUNNING", "Running CSEA analysis")
+
+            analysis_kwargs = dict(
+                output_dir=output_dir,
+                n_perm=n_perm,
+                seed=params["seed"],
+                adaptive=adaptive,
+                n_workers=ANALYSIS_WORKERS,
+                null_mode=null_mode,
+                null_library=(NullLibrary(os.path.join(CACHE_DIR, "null_library"), bucket=bucket)
+                              if null_mode == "shared" else None),
+                progress_callback=progress.stage_callback("analysis"),
+                timings=timings,
+                side_table_format=side_table_format,
+                plot_format=plot_format,
+                spill_dir=SPILL_DIR,
+            )
+            buffer = io.StringIO()
+            try:
+                with capture_output(buffer):
+                    if background_mode == "per_tissue":
+                        files = next(iter(annotations.values()))
+                        ret = run_csea_per_tissue(
+                            fp_cys=local_foreground_path,
+                            backgrounds=background_cys,
+                            fp_anno=files["fp_anno"],
+                            fp_anno_bgcys=files["fp_anno_bgcys"],
+                            fp_anno_index=files["fp_anno_index"],
+                            output_dir=output_dir,
+                            n_perm=n_perm,
+                            seed=params["seed"],
+                            progress_callback=progress.stage_callback("analysis"),
+                            timings=timings,
+                            side_table_format=side_table_format,
+                        )
+                    elif annotation_sel == "all":
+                        ret = run_csea_all_annotations(
+                            fp_cys=local_foreground_path,
+                            fp_bg=background_cys,
+                            annotations=annotations,
+                            **analysis_kwargs,
+                        )
+                    else:
+                        files = next(iter(annotations.values()))
+                        ret = run_csea_analysis(
+                            fp_cys=local_foreground_path,
+                            fp_bg=background_cys,
+                            fp_anno=files["fp_anno"],
+                            fp_anno_bgcys=files["fp_anno_bgcys"],
+                            fp_anno_index=files["fp_anno_index"],
+                            **analysis_kwargs,
+                        )
+            finally:
+                full_output = buffer.getvalue()
+                log_lines = full_output.splitlines()
+                update_job_status(job_ref, "RUNNING", "Analysis logs", logs=log_lines)
+
+            ret.update(cache_stats)
+
+            update_job_status(job_ref, "RUNNING", "Uploading results")
+            with timings.stage("upload"):
+                output_urls = upload_output_files(
+                    bucket, output_dir, job_id, progress.stage_callback("upload"))
+            ret["stage_timings"] = timings.as_dict()
+            stats = {k: v for k, v in ret.items() if k != 'fp_plot'}
+
+            update_job_status(
+                job_ref,
+                "COMPLETED",
+                "Analysis complete",
+                output_files=output_urls,
+                stats=stats,
+            )
+            job_ref.update({"resultKey": result_key})
+            store_cached_result(db, result_key, job_id, output_urls, stats)
+            progress.update("upload", 1.0)
+
+            print(ret)
+            return ret, output_urls
+
+        except Exception as e:
+            error_message = f"Error in analysis processing: {str(e)}\n{traceback.format_exc()}"
+            print(error_message)
+            update_job_status(job_ref, "ERROR", "Analysis failed", error=error_message)
+            raise
+        finally:
+            reference_cache.release(cache_pins)
+
+_job_queue = None
+_job_worker = None
+_job_queue_lock = threading.Lock()
+
+def enqueue_job(request_json: dict):
+    # CSEA_QUEUE=inprocess keeps the queue and a worker inside this process,
+    # for local runs against the Firestore/Storage emulators; otherwise jobs go
+    # to the analysis_worker Cloud Tasks queue.
+    global _job_queue, _job_worker
+    if QUEUE_BACKEND == "inprocess":
+        # one queue and worker per process, whichever request comes first
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = InProcessJobQueue()
+                _job_worker = JobWorker(
+                    _job_queue,
+                    lambda payload: process_job(payload, get_db(), get_bucket()),
+                    max_concurrency=WORKER_CONCURRENCY,
+                ).start()
+        _job_queue.enqueue(request_json)
+    else:
+        functions.task_queue("analysis_worker").enqueue(request_json)
+
 @https_fn.on_request(
     cors=options.CorsOptions(
         cors_origins=["*"],
         cors_methods=["GET", "POST", "OPTIONS"]
     ),
     memory=options.MemoryOption.GB_32,
-    timeout_sec=3600,
+    timeout_sec=JOB_TIMEOUT_SEC,
     cpu=8,
     min_instances=0,
     max_instances=10
@@ -114,105 +758,60 @@ def run_analysis(req: https_fn.Request) -> https_fn.Response:
             )
 
         job_id = request_json["jobId"]
-        foreground_file_path = request_json["foregroundFilePath"]
-        background_selections = request_json["backgroundSelections"]
-        annotation_sel = request_json.get("annotationSelection", "molecular")
-
-        db = firestore.client()
-        storage_client = cloud_storage.Client()
-        bucket = storage_client.bucket("zaro-lab.firebasestorage.app")
-        job_ref = db.collection("analysisJobs").document(job_id)
-
-        update_job_status(job_ref, "INITIALIZING", "Starting analysis")
+        db = get_db()
+        # the cache key is only ever computed here or in process_job
+        request_json.pop("resultKey", None)
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            try:
-                update_job_status(job_ref, "RUNNING", "Downloading input files")
-
-                local_foreground_path = os.path.join(temp_dir, f"{job_id}_foreground.csv")
-                download_blob(bucket, foreground_file_path, local_foreground_path)
-
-                local_background_path = merge_background_files(bucket, background_selections, temp_dir)
-
-                if annotation_sel == "molecular":
-                    anno_csv = "df_annotation_sub_molecular_features.csv"
-                    bgcys_csv = "bgcys_anno_molecular_features.csv"
-                elif annotation_sel == "experimental":
-                    anno_csv = "df_annotation_sub_experimental_data.csv"
-                    bgcys_csv = "bgcys_anno_experimental_data.csv"
-                elif annotation_sel == "structural":
-                    anno_csv = "df_annotation_sub_structural.csv"
-                    bgcys_csv = "bgcys_anno_structural.csv"
-                else:
-                    anno_csv = "df_annotation_sub_molecular_features.csv"
-                    bgcys_csv = "bgcys_anno_molecular_features.csv"
-
-                local_anno_path = os.path.join(temp_dir, "annotation.csv")
-                local_anno_bgcys_path = os.path.join(temp_dir, "anno_bgcys.csv")
-
-                download_blob(bucket, f"reference/{anno_csv}", local_anno_path)
-                download_blob(bucket, f"reference/{bgcys_csv}", local_anno_bgcys_path)
-
-                output_dir = os.path.join(temp_dir, f"results_{job_id}")
-                os.makedirs(output_dir, exist_ok=True)
-
-                update_job_status(job_ref, "RUNNING", "Running CSEA analysis")
-
-                buffer = io.StringIO()
-                old_stdout = sys.stdout
-                sys.stdout = buffer
-
-                try:
-                    ret = run_csea_analysis(
-                        fp_cys=local_foreground_path,
-                        fp_bg=local_background_path,
-                        fp_anno=local_anno_path,
-                        fp_anno_bgcys=local_anno_bgcys_path,
-                        output_dir=output_dir,
-                        n_perm=500,
+        if request_json.get("async", False):
+            job_ref = db.collection("analysisJobs").document(job_id)
+            bucket = get_bucket()
+            result_key = result_cache_key(
+                bucket,
+                bucket.blob(request_json["foregroundFilePath"]).download_as_bytes(),
+                request_json["backgroundSelections"],
+                analysis_params(request_json),
+            )
+            if not request_json.get("forceRerun", False):
+                # a duplicate submission is answered from the cache without queueing
+                cached = get_cached_result(db, bucket, result_key)
+                if cached is not None:
+                    stats, output_urls = complete_from_cache(job_ref, result_key, cached)
+                    return https_fn.Response(
+                        json.dumps({"message": "Analysis completed",
+                                    "outputFiles": output_urls,
+                                    "stats": stats,
+                                    "cachedFromJobId": cached["jobId"]}),
+                        status=200,
+                        headers={"Content-Type": "application/json"},
                     )
-                finally:
-                    sys.stdout = old_stdout
-                    full_output = buffer.getvalue()
-                    log_lines = full_output.splitlines()
-                    update_job_status(job_ref, "RUNNING", "Analysis logs", logs=log_lines)
-
-                output_urls = []
-                for filename in os.listdir(output_dir):
-                    if filename.endswith(".csv") or filename.endswith(".png"):
-                        local_path = os.path.join(output_dir, filename)
-                        remote_path = f"results/{job_id}/{filename}"
-                        signed_url = upload_results(bucket, local_path, remote_path)
-                        output_urls.append({"filename": filename, "url": signed_url})
-
-                update_job_status(
-                    job_ref,
-                    "COMPLETED",
-                    "Analysis complete",
-                    output_files=output_urls,
-                )
-
-                print(ret)
+            update_job_status(job_ref, "QUEUED", "Waiting for a worker", progress=0)
+            # the worker reuses the key instead of hashing the foreground again
+            enqueue_job(dict(request_json, resultKey=result_key))
+            return https_fn.Response(
+                json.dumps({"message": "Analysis queued", "jobId": job_id}),
+                status=202,
+                headers={"Content-Type": "application/json"},
+            )
 
-                return https_fn.Response(
-                    json.dumps({"message": "Analysis completed", 
-                                "outputFiles": output_urls, 
-                                "stats": {k:v for k,v in ret.items() if k != 'fp_plot'},
-                                "figures": {'barplot': ret['fp_plot']}
-                                }),
-                    status=200,
-                    headers={"Content-Type": "application/json"},
-                )
+        try:
+            ret, output_urls = process_job(request_json, db, get_bucket())
+        except Exception as e:
+            error_message = f"Error in analysis processing: {str(e)}\n{traceback.format_exc()}"
+            return https_fn.Response(
+                response={"error": error_message},
+                status=500,
+                headers={"Content-Type": "application/json"}
+            )
 
-            except Exception as e:
-                error_message = f"Error in analysis processing: {str(e)}\n{traceback.format_exc()}"
-                print(error_message)
-                update_job_status(job_ref, "ERROR", "Analysis failed", error=error_message)
-                return https_fn.Response(
-                    response={"error": error_message},
-                    status=500,
-                    headers={"Content-Type": "application/json"}
-                )
+        return https_fn.Response(
+            json.dumps({"message": "Analysis completed", 
+                        "outputFiles": output_urls, 
+                        "stats": {k:v for k,v in ret.items() if k != 'fp_plot'},
+                        "figures": {'barplot': ret.get('fp_plot')}
+                        }),
+            status=200,
+            headers={"Content-Type": "application/json"},
+        )
 
     except Exception as e:
         error_message = f"Error in request handling: {str(e)}\n{traceback.format_exc()}"
@@ -223,6 +822,33 @@ def run_analysis(req: https_fn.Request) -> https_fn.Response:
             headers={"Content-Type": "application/json"}
         )
 
+@tasks_fn.on_task_dispatched(
+    retry_config=options.RetryConfig(max_attempts=1),
+    rate_limits=options.RateLimits(max_concurrent_dispatches=WORKER_CONCURRENCY),
+    memory=options.MemoryOption.GB_32,
+    timeout_sec=JOB_TIMEOUT_SEC,
+    cpu=8,
+    min_instances=0,
+    max_instances=10
+)
+def analysis_worker(req: tasks_fn.CallableRequest) -> None:
+    # drains the queue filled by run_analysis in async mode; a failed job is
+    # already marked ERROR on its document, so it is not retried
+    try:
+        process_job(req.data, get_db(), get_bucket())
+    except Exception:
+        print(f"Job {req.data.get('jobId')} failed in worker:\n{traceback.format_exc()}")
+
+@scheduler_fn.on_schedule(schedule="every 15 minutes", memory=options.MemoryOption.MB_512)
+def expire_stale_jobs_scheduled(event: scheduler_fn.ScheduledEvent) -> None:
+    n_expired = expire_stale_jobs(get_db())
+    print(f"Marked {n_expired} jobs past their deadline as failed")
+
+@scheduler_fn.on_schedule(schedule="every day 03:00", memory=options.MemoryOption.MB_512)
+def evict_result_cache_daily(event: scheduler_fn.ScheduledEvent) -> None:
+    n_deleted = evict_result_cache(get_db())
+    print(f"Evicted {n_deleted} result cache entries older than {RESULT_CACHE_TTL_DAYS} days")
+
 @https_fn.on_request(
     cors=options.CorsOptions(
         cors_origins=["*"],
@@ -246,11 +872,15 @@ def preview_csv(req: https_fn.Request) -> https_fn.Response:
         if req.method == "GET":
             job_id = req.args.get("jobId")
             filename = req.args.get("filename")
+            offset = req.args.get("offset", 0)
+            limit = req.args.get("limit", 20)
         elif req.method == "POST":
             try:
                 request_json = req.get_json()
                 job_id = request_json.get("jobId")
                 filename = request_json.get("filename")
+                offset = request_json.get("offset", 0)
+                limit = request_json.get("limit", 20)
             except ValueError:
                 return https_fn.Response(
                     response={"error": "Invalid JSON payload"},
@@ -271,45 +901,198 @@ def preview_csv(req: https_fn.Request) -> https_fn.Response:
                 headers={"Content-Type": "application/json"}
             )
 
-        storage_client = cloud_storage.Client()
-        bucket = storage_client.bucket("zaro-lab.firebasestorage.app")
+        try:
+            offset = max(int(offset), 0)
+            limit = min(max(int(limit), 1), PREVIEW_MAX_LIMIT)
+        except (TypeError, ValueError):
+            return https_fn.Response(
+                response={"error": "offset and limit must be integers"},
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
+
+        bucket = get_bucket()
         
-        if (filename.startswith("output_") or 
-            filename.startswith("result_") or 
-            filename in ["enrichment.csv", "binned.csv"]):
-            file_path = f"results/{job_id}/{filename}"
+        # results of an "all" job sit in one subdirectory per annotation family
+        family, _, basename = filename.rpartition("/")
+        if (family in ("", *ANNOTATION_FILES)) and (
+            basename.startswith("output_") or
+            basename.startswith("result_") or
+            basename in ["enrichment.csv", "binned.csv"]):
+            file_path = f"results/{result_job_id(get_db(), job_id)}/{filename}"
         else:
             file_path = f"uploads/{job_id}/{filename}"
         
-        with tempfile.NamedTemporaryFile(suffix='.csv') as temp_file:
-            try:
-                download_blob(bucket, file_path, temp_file.name)
-                
-                df = pd.read_csv(temp_file.name, nrows=20)
-                
+        try:
+            blob = bucket.get_blob(file_path)
+            if blob is None:
+                return https_fn.Response(
+                    response={"error": f"File not found: {filename}"},
+                    status=404,
+                    headers={"Content-Type": "application/json"}
+                )
+
+            cache_key = (file_path, blob.generation, offset, limit)
+            with _preview_cache_lock:
+                preview_data = _preview_cache.get(cache_key)
+                if preview_data is not None:
+                    _preview_cache.move_to_end(cache_key)
+
+            if preview_data is None and filename.endswith(".parquet"):
+                return https_fn.Response(
+                    response={"error": "Preview is only available for CSV files"},
+                    status=415,
+                    headers={"Content-Type": "application/json"}
+                )
+
+            if preview_data is None and (filename.endswith(".gz") or blob.content_encoding == "gzip"):
+                # byte ranges of a gzip file are not meaningful, so the whole
+                # object is fetched and decompressed (objects uploaded with
+                # Content-Encoding: gzip arrive already decompressed)
+                import pandas as pd
+                data = blob.download_as_bytes()
+                if data[:2] == b"\x1f\x8b":
+                    data = gzip.decompress(data)
+                df = pd.read_csv(io.BytesIO(data), skiprows=range(1, offset + 1), nrows=limit)
+                reached_end = True
+                n_rows_seen = max(data.count(b"\n") - 1, 0)
+            elif preview_data is None:
+                df, reached_end, n_rows_seen = read_csv_rows_ranged(blob, offset, limit)
+
+            if preview_data is None:
+                total_rows = (blob.metadata or {}).get("rowCount")
+                if total_rows is not None:
+                    total_rows = int(total_rows)
+                elif reached_end:
+                    total_rows = n_rows_seen
+
                 preview_data = {
                     "headers": df.columns.tolist(),
                     "rows": df.values.tolist(),
                     "rowCount": len(df),
-                    "totalRows": pd.read_csv(temp_file.name, skiprows=lambda x: x > 0, nrows=1).shape[0] if df.shape[0] > 0 else 0
+                    "totalRows": total_rows,
+                    "offset": offset,
+                    "limit": limit,
+                    "hasMore": (offset + len(df) < total_rows) if total_rows is not None
+                               else not reached_end or n_rows_seen > offset + len(df),
                 }
-                
+                with _preview_cache_lock:
+                    _preview_cache[cache_key] = preview_data
+                    while len(_preview_cache) > PREVIEW_CACHE_SIZE:
+                        _preview_cache.popitem(last=False)
+
+            return https_fn.Response(
+                json.dumps(preview_data),
+                status=200,
+                headers={"Content-Type": "application/json"}
+            )
+
+        except Exception as e:
+            error_message = f"Error retrieving or processing CSV file: {str(e)}"
+            print(error_message)
+            print(traceback.format_exc())
+            return https_fn.Response(
+                response={"error": error_message},
+                status=500,
+                headers={"Content-Type": "application/json"}
+            )
+    
+    except Exception as e:
+        error_message = f"Error in request handling: {str(e)}"
+        print(error_message)
+        print(traceback.format_exc())
+        return https_fn.Response(
+            response={"error": error_message},
+            status=500,
+            headers={"Content-Type": "application/json"}
+        )
+
+@https_fn.on_request(
+    cors=options.CorsOptions(
+        cors_origins=["*"],
+        cors_methods=["GET", "POST", "OPTIONS"]
+    ),
+    memory=options.MemoryOption.GB_1,
+    timeout_sec=60
+)
+def render_plot(req: https_fn.Request) -> https_fn.Response:
+    # Renders results/<jobId>/csea_barplot.<format> from the job's result table
+    # on first request and returns its URL; later requests reuse the upload.
+    if req.method == "OPTIONS":
+        return https_fn.Response(
+            status=204,
+            headers={
+                "Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
+                "Access-Control-Allow-Headers": "Content-Type, Authorization"
+            }
+        )
+
+    try:
+        if req.method == "POST":
+            try:
+                params = req.get_json()
+            except ValueError:
                 return https_fn.Response(
-                    json.dumps(preview_data),
-                    status=200,
+                    response={"error": "Invalid JSON payload"},
+                    status=400,
                     headers={"Content-Type": "application/json"}
                 )
-                
-            except Exception as e:
-                error_message = f"Error retrieving or processing CSV file: {str(e)}"
-                print(error_message)
-                print(traceback.format_exc())
+        else:
+            params = req.args
+        job_id = params.get("jobId")
+        fmt = params.get("format", "png")
+        # matplotlib and pandas are only loaded by the endpoint that draws
+        import pandas as pd
+        from plotting import PLOT_FORMATS, render_feature_plot
+
+        if not job_id:
+            return https_fn.Response(
+                response={"error": "Missing required parameter: jobId"},
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
+        if fmt not in PLOT_FORMATS:
+            return https_fn.Response(
+                response={"error": f"Unsupported plot format: {fmt}"},
+                status=400,
+                headers={"Content-Type": "application/json"}
+            )
+
+        job_id = result_job_id(get_db(), job_id)
+        bucket = get_bucket()
+        filename = f"csea_barplot.{fmt}"
+        remote_path = f"results/{job_id}/{filename}"
+        url = f"https://storage.googleapis.com/{bucket.name}/{remote_path}"
+
+        if bucket.get_blob(remote_path) is None:
+            result_blobs = [
+                blob for blob in bucket.list_blobs(prefix=f"results/{job_id}/result_")
+                if re.search(r"_seed\d+\.csv$", blob.name)
+            ]
+            if not result_blobs:
                 return https_fn.Response(
-                    response={"error": error_message},
-                    status=500,
+                    response={"error": f"No result table found for job {job_id}"},
+                    status=404,
                     headers={"Content-Type": "application/json"}
                 )
-    
+            df = pd.read_csv(io.BytesIO(result_blobs[0].download_as_bytes()))
+            with tempfile.TemporaryDirectory() as temp_dir:
+                fp_plot = render_feature_plot(df, os.path.join(temp_dir, filename), fmt)
+                if fp_plot is None:
+                    return https_fn.Response(
+                        json.dumps({"filename": None, "url": None, "message": "No significant features to plot"}),
+                        status=200,
+                        headers={"Content-Type": "application/json"}
+                    )
+                url = upload_results(bucket, fp_plot, remote_path)
+
+        return https_fn.Response(
+            json.dumps({"filename": filename, "url": url}),
+            status=200,
+            headers={"Content-Type": "application/json"}
+        )
+
     except Exception as e:
         error_message = f"Error in request handling: {str(e)}"
         print(error_message)
@@ -318,4 +1101,4 @@ def preview_csv(req: https_fn.Request) -> https_fn.Response:
             response={"error": error_message},
             status=500,
             headers={"Content-Type": "application/json"}
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import os
+import uuid
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from csea500b import compute_null_counts_many, fit_null_density, get_annotated_cys
+from cys_ids import read_cys_ids
+
+
+# Nulls are keyed by the counts compute_null_counts draws them from. Bump
+# NULL_VERSION whenever the draws change, so older stored nulls are not read.
+NULL_VERSION = 2
+
+
+def null_key(n_bg: int, n_fg: int, size_per_perm: int, n_perm: int, seed: int) -> str:
+    return f"v{NULL_VERSION}_bg{n_bg}_fg{n_fg}_k{size_per_perm}_perm{n_perm}_seed{seed}"
+
+
+class NullLibrary:
+    # Persistent store of null count distributions, one .npz per null_key under
+    # root. With a bucket, misses are looked up under gs://<bucket>/<prefix>
+    # before computing, and newly computed nulls are uploaded there.
+
+    def __init__(self, root: str, bucket=None, prefix: str = "null_library"):
+        self.root = root
+        self.bucket = bucket
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _local_path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.npz")
+
+    def _remote_path(self, key: str) -> str:
+        return f"{self.prefix}/{key}.npz"
+
+    def _save(self, key: str, n_intersect) -> str:
+        fp = self._local_path(key)
+        part = f"{fp}.{uuid.uuid4().hex}.part.npz"
+        np.savez(part, ls_n_intersection=np.asarray(n_intersect, dtype=np.int32))
+        os.replace(part, fp)
+        return fp
+
+    def _load(self, key: str):
+        fp = self._local_path(key)
+        if not os.path.exists(fp) and self.bucket is not None:
+            blob = self.bucket.get_blob(self._remote_path(key))
+            if blob is not None:
+                part = f"{fp}.{uuid.uuid4().hex}.part"
+                blob.download_to_filename(part)
+                os.replace(part, fp)
+        if not os.path.exists(fp):
+            return None
+        with np.load(fp) as npz:
+            return npz['ls_n_intersection'].tolist()
+
+    def get_null(self, n_bg: int, n_fg: int, size_per_perm: int, n_perm: int, seed: int):
+        return self.get_nulls([(n_bg, n_fg, size_per_perm)], n_perm, seed)[0]
+
+    def get_nulls(self, ls_sizes, n_perm: int, seed: int):
+        # fitted nulls for several (n_bg, n_fg, size_per_perm) triples,
+        # computing and storing the misses together from one block of draws;
+        # the density is refitted from the stored counts, which is deterministic
+        ls_key = [null_key(n_bg, n_fg, size, n_perm, seed) for n_bg, n_fg, size in ls_sizes]
+        counts = {}
+        for key in ls_key:
+            if key not in counts:
+                counts[key] = self._load(key)
+        ls_missing = [triple for triple, key in zip(ls_sizes, ls_key) if counts[key] is None]
+        ls_missing = list(dict.fromkeys(ls_missing))
+        self.hits += len(ls_sizes) - len(ls_missing)
+        self.misses += len(ls_missing)
+        for triple, n_intersect in zip(ls_missing, compute_null_counts_many(ls_missing, n_perm, seed)):
+            key = null_key(*triple, n_perm, seed)
+            counts[key] = n_intersect
+            fp = self._save(key, n_intersect)
+            if self.bucket is not None:
+                self.bucket.blob(self._remote_path(key)).upload_from_filename(fp)
+        return [fit_null_density(counts[key]) for key in ls_key]
+
+
+def prewarm(library: NullLibrary, fp_bgs, fp_anno_bgcys: str, sizes, n_perm: int, seed: int):
+    # precompute nulls for foreground lists of each size against each
+    # background. A run draws as many cysteines as it has annotated
+    # foreground cysteines in the background, so its key has n_fg == size
+    ls_bgcys_anno = pd.read_csv(fp_anno_bgcys, header=None)[0].to_list()
+    for fp_bg in fp_bgs:
+        S_bg, _ = read_cys_ids(fp_bg)
+        n_bg = len(get_annotated_cys(S_bg, ls_bgcys_anno))
+        library.get_nulls([(n_bg, size, size) for size in sizes if size <= n_bg], n_perm, seed)
+        print(f"{os.path.basename(fp_bg)}: {n_bg} annotated background cysteines, "
+              f"{library.hits} hits, {library.misses} computed so far")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pre-warm the CSEA null library for standard tissue backgrounds')
+    parser.add_argument('--bg_dir', required=True, help='Directory of aggregated_tissue_cysteines background CSVs')
+    parser.add_argument('--fp_anno_bgcys', required=True, help='Path to unique background cysteins in the annotation CSV file')
+    parser.add_argument('--library_dir', required=True, help='Null library directory')
+    parser.add_argument('--sizes', type=int, nargs='+', required=True,
+                        help='Sizes to precompute: annotated foreground cysteines in the background')
+    parser.add_argument('--n_perm', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=34)
+    args = parser.parse_args()
+
+    prewarm(
+        NullLibrary(args.library_dir),
+        sorted(glob(os.path.join(args.bg_dir, '*.csv'))),
+        args.fp_anno_bgcys,
+        args.sizes,
+        args.n_perm,
+        args.seed,
+    )
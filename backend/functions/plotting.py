@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+PLOT_FORMATS = ('png', 'svg', 'json')
+
+
+def feature_plot_data(df, p_final: float = 0.05, top_n: int = 20) -> pd.DataFrame:
+    # top_n significant sets in table order, with -log10p, sorted for a barh plot
+    df = df[df['p_final'] < p_final]
+    df = df[['set_name', 'p_final']].head(top_n).copy()
+    df['-log10p'] = -np.log10(df['p_final'].to_numpy(dtype=float))
+    return df[['set_name', '-log10p']].sort_values('-log10p', ascending=True)
+
+
+def feature_plot_spec(df_plot: pd.DataFrame) -> dict:
+    # what the frontend needs to draw the bar plot itself
+    return {
+        'type': 'barh',
+        'title': 'Cysteine Enrichment Analysis',
+        'xlabel': '-log10(p)',
+        'ylabel': 'Enriched Features (upto Top 20)',
+        'bars': [
+            {'label': label, 'value': float(value)}
+            for label, value in zip(df_plot['set_name'], df_plot['-log10p'])
+        ],
+    }
+
+
+def draw_feature_plot(df_plot: pd.DataFrame) -> Figure:
+    # a standalone Figure, not registered with pyplot, so it is freed with the object
+    fig = Figure(figsize=(5, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    # bars at positions with the names as tick labels, so sets that share a
+    # name (possible across annotation families) each keep their own row
+    positions = np.arange(len(df_plot))
+    ax.barh(positions, df_plot['-log10p'], color='skyblue', label='-log10p')
+    ax.set_yticks(positions)
+    ax.set_yticklabels(df_plot['set_name'])
+    ax.legend()
+    ax.set_title('Cysteine Enrichment Analysis')
+    ax.set_xlabel('-log10(p)')
+    ax.set_ylabel('Enriched Features (upto Top 20)')
+    return fig
+
+
+def render_feature_plot(df, fpout: str, fmt: str = 'png', p_final: float = 0.05, dpi: int = 300) -> str:
+    # Renders the significant-feature bar plot to fpout as PNG, SVG or a JSON
+    # plot spec. Returns None when no set passes p_final.
+    if fmt not in PLOT_FORMATS:
+        raise ValueError(f"Unknown plot format: {fmt}")
+    df_plot = feature_plot_data(df, p_final)
+    if df_plot.shape[0] == 0:
+        return None
+
+    if fmt == 'json':
+        with open(fpout, 'w') as f:
+            json.dump(feature_plot_spec(df_plot), f)
+        return fpout
+
+    fig = draw_feature_plot(df_plot)
+    try:
+        fig.savefig(fpout, format=fmt, dpi=dpi, bbox_inches='tight')
+    finally:
+        fig.clear()
+    return fpout
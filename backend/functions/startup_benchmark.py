@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import subprocess
+
+
+HEAVY_MODULES = ('pandas', 'scipy', 'statsmodels', 'matplotlib', 'tqdm', 'csea500b')
+
+# First request per endpoint. Without emulators or credentials these fail
+# fast after the handler has done its imports and created its clients,
+# which is the part of the latency that cold starts add; pass --requests for
+# real payloads against the Firestore/Storage emulators.
+DEFAULT_REQUESTS = {
+    'preview_csv': {'method': 'GET', 'args': {'jobId': 'startup-benchmark', 'filename': 'result_startup.csv'}},
+    'render_plot': {'method': 'GET', 'args': {'jobId': 'startup-benchmark', 'format': 'json'}},
+    'run_analysis': {'method': 'POST', 'json': {'jobId': 'startup-benchmark'}},
+}
+
+# Runs in a fresh interpreter, so every measurement is a cold start of main.
+_PROBE = r'''
+import json, os, sys, time
+heavy = json.loads(os.environ["STARTUP_HEAVY_MODULES"])
+case = json.loads(os.environ["STARTUP_CASE"])
+loaded = lambda: sorted(m for m in heavy if m in sys.modules)
+
+t0 = time.perf_counter()
+import main
+result = {"import_s": time.perf_counter() - t0, "heavy_after_import": loaded()}
+
+if case:
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+    handler = getattr(main, case["endpoint"])
+    def call():
+        builder = EnvironBuilder(method=case["method"], path="/", query_string=case.get("args"),
+                                 json=case.get("json"))
+        t0 = time.perf_counter()
+        response = handler(Request(builder.get_environ()))
+        return time.perf_counter() - t0, response.status_code
+    result["first_request_s"], result["status"] = call()
+    result["heavy_after_request"] = loaded()
+    result["second_request_s"], _ = call()
+print("STARTUP_RESULT " + json.dumps(result))
+'''
+
+
+def run_probe(case: dict = None) -> dict:
+    env = dict(os.environ,
+               STARTUP_HEAVY_MODULES=json.dumps(HEAVY_MODULES),
+               STARTUP_CASE=json.dumps(case or {}))
+    proc = subprocess.run([sys.executable, '-c', _PROBE], cwd=os.path.dirname(os.path.abspath(__file__)),
+                          env=env, capture_output=True, text=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith('STARTUP_RESULT '):
+            return json.loads(line[len('STARTUP_RESULT '):])
+    raise RuntimeError(f"Startup probe failed:\n{proc.stderr}")
+
+
+def run_startup_benchmark(requests: dict = None, repeats: int = 3) -> dict:
+    # import time of main on its own, then per endpoint the import time and
+    # the latency of the first and second request, best of repeats cold starts
+    if requests is None:
+        requests = DEFAULT_REQUESTS
+    best = lambda runs, key: round(min(r[key] for r in runs), 4)
+
+    runs = [run_probe() for _ in range(repeats)]
+    report = {
+        'import': {'import_s': best(runs, 'import_s'), 'heavy_after_import': runs[0]['heavy_after_import']},
+        'endpoints': {},
+    }
+    for endpoint, case in requests.items():
+        runs = [run_probe(dict(case, endpoint=endpoint)) for _ in range(repeats)]
+        report['endpoints'][endpoint] = {
+            'import_s': best(runs, 'import_s'),
+            'first_request_s': best(runs, 'first_request_s'),
+            'second_request_s': best(runs, 'second_request_s'),
+            'status': runs[0]['status'],
+            'heavy_after_request': runs[0]['heavy_after_request'],
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Cold-start import time and first-request latency per endpoint')
+    parser.add_argument('--requests', default=None,
+                        help='JSON file of {endpoint: {"method", "args" or "json"}} to send instead of the defaults')
+    parser.add_argument('--repeats', type=int, default=3, help='Cold starts per measurement; the best is reported')
+    parser.add_argument('--output', default=None, help='Where to write the report JSON')
+    args = parser.parse_args()
+
+    requests = None
+    if args.requests is not None:
+        with open(args.requests) as f:
+            requests = json.load(f)
+
+    report = run_startup_benchmark(requests, args.repeats)
+    print(f"import main: {report['import']['import_s']}s, "
+          f"heavy modules loaded: {report['import']['heavy_after_import'] or 'none'}")
+    for endpoint, r in report['endpoints'].items():
+        print(f"{endpoint}: first request {r['first_request_s']}s (status {r['status']}), "
+              f"second {r['second_request_s']}s, heavy modules: {r['heavy_after_request'] or 'none'}")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved startup benchmark to {args.output}")